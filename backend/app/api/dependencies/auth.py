@@ -1,4 +1,6 @@
-from typing import Annotated
+import hashlib
+import time
+from typing import Annotated, Literal
 
 import jwt
 from fastapi import Depends, HTTPException, status
@@ -6,11 +8,13 @@ from fastapi.security import OAuth2PasswordBearer
 from jwt.exceptions import InvalidTokenError
 from pydantic import ValidationError
 
-from app.api.dependencies.db import SessionDep
+from app.api.dependencies.db import PrimaryReadSessionDep, SessionDep
+from app.cache import TTLLRUCache
 from app.config import settings
-from app.crud.user import get_user
+from app.crud.user import get_user, get_user_snapshot
 from app.models.user import UserDB
 from app.schemas.auth import TokenPayload
+from app.schemas.user import UserSnapshot
 from app.utils.auth import ACCESS_TOKEN_ALGORITHM
 
 reusable_oauth2 = OAuth2PasswordBearer(
@@ -20,22 +24,56 @@ reusable_oauth2 = OAuth2PasswordBearer(
 TokenDep = Annotated[str, Depends(reusable_oauth2)]
 
 
-async def get_current_user(session: SessionDep, token: TokenDep) -> UserDB:
+# Clients send the same token with every request, so the verified payloads are kept
+# until the tokens expire. The keys are digests to not keep the tokens themselves.
+token_cache: TTLLRUCache[bytes, TokenPayload] = TTLLRUCache(
+    settings.TOKEN_CACHE_MAX_SIZE
+)
+
+
+def decode_token(
+    token: str, token_type: Literal["access", "refresh"] = "access"
+) -> TokenPayload:
+    digest = hashlib.sha256(token.encode()).digest()
+    token_data = token_cache.get(digest)
     try:
-        payload = jwt.decode(
-            token, settings.SECRET_KEY, algorithms=[ACCESS_TOKEN_ALGORITHM]
-        )
-        token_data = TokenPayload(**payload)
-        if token_data.sub is None:
+        if token_data is None:
+            payload = jwt.decode(
+                token, settings.SECRET_KEY, algorithms=[ACCESS_TOKEN_ALGORITHM]
+            )
+            token_data = TokenPayload(**payload)
+            if token_data.exp is not None:
+                ttl = token_data.exp - time.time()
+                if ttl > 0:
+                    token_cache.set(digest, token_data, ttl=ttl)
+        if token_data.sub is None or token_data.type != token_type:
             raise InvalidTokenError
     except (InvalidTokenError, ValidationError):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Could not validate credentials.",
         )
-    user = await get_user(session, token_data.sub)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found.")
+    return token_data
+
+
+async def get_token_payload(token: TokenDep) -> TokenPayload:
+    return decode_token(token)
+
+
+TokenPayloadDep = Annotated[TokenPayload, Depends(get_token_payload)]
+
+
+def check_token_version(token_data: TokenPayload, token_version: int) -> None:
+    # Tokens issued without the version can't be revoked this way
+    if token_data.ver is not None and token_data.ver != token_version:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Token has been revoked."
+        )
+
+
+async def get_current_user(session: SessionDep, token_data: TokenPayloadDep) -> UserDB:
+    user = await get_user(session, token_data.sub)  # type: ignore
+    check_token_version(token_data, user.token_version)
     if not user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user.")
     return user
@@ -44,7 +82,30 @@ async def get_current_user(session: SessionDep, token: TokenDep) -> UserDB:
 CurrentUser = Annotated[UserDB, Depends(get_current_user)]
 
 
-def get_current_active_superuser(current_user: CurrentUser) -> UserDB:
+async def get_current_user_snapshot(
+    session: PrimaryReadSessionDep, token_data: TokenPayloadDep
+) -> UserSnapshot:
+    """Lightweight version of `get_current_user` for the routes which don't need the
+    whole user. The snapshot is built from the token claims while they are fresh,
+    otherwise it's served from the user cache when possible.
+
+    The user is loaded from the primary, a lagging replica could let a revoked token
+    through and cache the stale user. The connection isn't held for the rest of the
+    request.
+    """
+    user = token_data.fresh_claims()
+    if user is None:
+        user = await get_user_snapshot(session, token_data.sub)  # type: ignore
+        check_token_version(token_data, user.token_version)
+    if not user.is_active:
+        raise HTTPException(status_code=400, detail="Inactive user.")
+    return user
+
+
+CurrentUserSnapshot = Annotated[UserSnapshot, Depends(get_current_user_snapshot)]
+
+
+def get_current_active_superuser(current_user: CurrentUserSnapshot) -> UserSnapshot:
     if not current_user.is_superuser:
         raise HTTPException(
             status_code=403, detail="The user doesn't have enough privileges."
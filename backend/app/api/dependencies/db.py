@@ -1,8 +1,42 @@
-from typing import Annotated
+from contextlib import AbstractAsyncContextManager
+from typing import Annotated, AsyncIterator, Callable
 
 from fastapi import Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database import get_db_session
+from app.database import LazySession, get_db_session, sessionmanager
 
-SessionDep = Annotated[AsyncSession, Depends(get_db_session)]
+SessionDep = Annotated[LazySession, Depends(get_db_session)]
+
+
+async def get_db_read_session(session: SessionDep) -> AsyncIterator[LazySession]:
+    async with sessionmanager.read_session(session) as read_session:
+        yield read_session
+
+
+ReadSessionDep = Annotated[LazySession, Depends(get_db_read_session)]
+
+
+async def get_db_primary_read_session(
+    session: SessionDep,
+) -> AsyncIterator[LazySession]:
+    """Like `get_db_read_session` for the reads which must see the latest writes,
+    e.g. of the credentials. The connection is still released after every query.
+    """
+    async with sessionmanager.read_session(session, use_replica=False) as read_session:
+        yield read_session
+
+
+PrimaryReadSessionDep = Annotated[LazySession, Depends(get_db_primary_read_session)]
+
+SessionFactory = Callable[[], AbstractAsyncContextManager[AsyncSession]]
+
+
+def get_session_factory() -> SessionFactory:
+    """Opens sessions of their own for the background tasks, which run after the
+    session of the request is closed.
+    """
+    return sessionmanager.session
+
+
+SessionFactoryDep = Annotated[SessionFactory, Depends(get_session_factory)]
@@ -1,7 +1,8 @@
 from fastapi import APIRouter
 
-from app.api.routes import login, users
+from app.api.routes import login, users, utils
 
 api_router = APIRouter()
 api_router.include_router(login.router, tags=["login"])
 api_router.include_router(users.router, prefix="/users", tags=["users"])
+api_router.include_router(utils.router, prefix="/utils", tags=["utils"])
@@ -1,35 +1,143 @@
+import math
+import time
 from datetime import timedelta
-from typing import Annotated
+from typing import Annotated, Any
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
 from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy import Row
 
-from app.api.dependencies.db import SessionDep
+from app.api.dependencies.auth import check_token_version, decode_token
+from app.api.dependencies.db import (
+    PrimaryReadSessionDep,
+    SessionDep,
+    SessionFactory,
+    SessionFactoryDep,
+)
+from app.cache import used_refresh_tokens
 from app.config import settings
-from app.crud.user import authenticate
-from app.schemas.auth import Token
-from app.utils.auth import create_access_token
+from app.crud.user import (
+    USER_SNAPSHOT_COLUMNS,
+    authenticate,
+    commit,
+    get_user_row,
+    rehash_password,
+    revoke_tokens,
+)
+from app.metrics import rate_limited_requests
+from app.models.user import UserDB
+from app.rate_limit import login_ip_limiter, login_username_limiter
+from app.schemas.auth import RefreshTokenRequest, Token
+from app.utils.auth import create_access_token, create_refresh_token
 
 router = APIRouter()
 
 
+def create_user_access_token(user: UserDB | Row[Any]) -> str:
+    claims = {"ver": user.token_version}
+    if settings.ACCESS_TOKEN_CLAIMS_EXPIRE_SECONDS:
+        claims |= {
+            "is_superuser": user.is_superuser,
+            "is_active": user.is_active,
+            "claims_exp": int(time.time())
+            + settings.ACCESS_TOKEN_CLAIMS_EXPIRE_SECONDS,
+        }
+    return create_access_token(
+        user.id,
+        expiration_delta=timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES),
+        claims=claims,
+    )
+
+
+def create_user_tokens(user: UserDB | Row[Any]) -> Token:
+    return Token(
+        access_token=create_user_access_token(user),
+        refresh_token=create_refresh_token(
+            user.id,
+            user.token_version,
+            expiration_delta=timedelta(minutes=settings.REFRESH_TOKEN_EXPIRE_MINUTES),
+        ),
+    )
+
+
+async def check_login_rate_limit(request: Request, username: str) -> None:
+    """Reject the login attempt before the user lookup and the password check if
+    the username or the client IP is over the limit.
+    """
+    retry_after = 0.0
+    keys = [(login_username_limiter, username.lower())]
+    if request.client:
+        keys.append((login_ip_limiter, request.client.host))
+    for limiter, key in keys:
+        wait = await limiter.hit(key)
+        if wait:
+            rate_limited_requests.inc(limiter=limiter.name)
+            retry_after = max(retry_after, wait)
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many login attempts.",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
+async def rehash_user_password(
+    session_factory: SessionFactory, user_id: int, hashed_password: str, password: str
+) -> None:
+    async with session_factory() as session:
+        await rehash_password(session, user_id, hashed_password, password)
+        await session.commit()
+
+
 @router.post("/login/access-token")
 async def login_access_token(
-    session: SessionDep, form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
+    request: Request,
+    session: PrimaryReadSessionDep,
+    session_factory: SessionFactoryDep,
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    background_tasks: BackgroundTasks,
 ) -> Token:
     """
-    OAuth2 compatible token login, get an access token for future requests
+    OAuth2 compatible token login, get an access token for future requests.
+    Outdated password hashes are upgraded after the response is sent.
     """
-    user = await authenticate(
+    await check_login_rate_limit(request, form_data.username)
+    # The session releases the connection of the lookup before the password check
+    authentication = await authenticate(
         session=session, username=form_data.username, password=form_data.password
     )
-    if not user:
+    if not authentication:
         raise HTTPException(status_code=400, detail="Incorrect username or password.")
-    elif not user.is_active:
+    user, needs_rehash = authentication
+    if not user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user.")
-    access_token_expiration = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    return Token(
-        access_token=create_access_token(
-            user.id, expiration_delta=access_token_expiration
+    if needs_rehash:
+        background_tasks.add_task(
+            rehash_user_password,
+            session_factory,
+            user.id,
+            user.hashed_password,
+            form_data.password,
         )
+    return create_user_tokens(user)
+
+
+@router.post("/login/refresh-token")
+async def login_refresh_token(session: SessionDep, body: RefreshTokenRequest) -> Token:
+    """
+    Exchange a refresh token for new access and refresh tokens. Every refresh token
+    can be used once, a reused one revokes all tokens of the user.
+    """
+    token_data = decode_token(body.refresh_token, "refresh")
+    if await used_refresh_tokens.get(token_data.jti):
+        await revoke_tokens(session, token_data.sub)  # type: ignore
+        await commit(session)
+        raise HTTPException(status_code=403, detail="Token has been revoked.")
+    await used_refresh_tokens.set(token_data.jti, True)
+    user = await get_user_row(
+        session, token_data.sub, USER_SNAPSHOT_COLUMNS  # type: ignore
     )
+    check_token_version(token_data, user.token_version)
+    if not user.is_active:
+        raise HTTPException(status_code=400, detail="Inactive user.")
+    return create_user_tokens(user)
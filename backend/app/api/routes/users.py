@@ -1,51 +1,245 @@
-from typing import Annotated, Any
+import functools
+from typing import Annotated, Any, AsyncIterator, Literal
 
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy import select
+from fastapi import APIRouter, Body, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 
 import app.crud.user as crud_user
 import app.schemas.user as schemas_user
-from app.api.dependencies.auth import CurrentUser, get_current_active_superuser
-from app.api.dependencies.db import SessionDep
-from app.models.user import UserDB
+from app.api.dependencies.auth import (
+    CurrentUser,
+    CurrentUserSnapshot,
+    get_current_active_superuser,
+)
+from app.api.dependencies.db import ReadSessionDep, SessionDep
+from app.config import settings
+from app.schemas.bulk import BulkResult
 from app.schemas.message import Message
-from app.utils.auth import get_password_hash, verify_password
+from app.utils.auth import password_hasher
+from app.utils.export import iter_csv, iter_ndjson
+from app.utils.pagination import decode_cursor, encode_cursor
+from app.utils.serialization import FastJSONResponse, RowSerializer, parse_fields
 
 router = APIRouter()
 
 
+def get_user_fields(
+    fields: Annotated[
+        str | None,
+        Query(
+            description="Comma-separated fields of the users to return, all of them "
+            "by default.",
+            examples=["id,username"],
+        ),
+    ] = None,
+) -> tuple[str, ...]:
+    if fields is None:
+        return crud_user.USER_PUBLIC_COLUMNS
+    try:
+        return parse_fields(schemas_user.UserPublic, fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+UserFieldsDep = Annotated[tuple[str, ...], Depends(get_user_fields)]
+
+
+def get_user_filter(
+    is_active: bool | None = None,
+    is_superuser: bool | None = None,
+    username_prefix: Annotated[
+        str | None,
+        Query(min_length=1, description="Case-sensitive prefix of the username."),
+    ] = None,
+    email_prefix: Annotated[
+        str | None,
+        Query(min_length=1, description="Case-sensitive prefix of the email."),
+    ] = None,
+) -> schemas_user.UserFilter:
+    return schemas_user.UserFilter(
+        is_active=is_active,
+        is_superuser=is_superuser,
+        username_prefix=username_prefix,
+        email_prefix=email_prefix,
+    )
+
+
+UserFilterDep = Annotated[schemas_user.UserFilter, Depends(get_user_filter)]
+
+
+@functools.cache
+def get_user_serializer(fields: tuple[str, ...]) -> RowSerializer:
+    return RowSerializer(schemas_user.UserPublic, fields)
+
+
 @router.get(
     "/",
     dependencies=[Depends(get_current_active_superuser)],
     response_model=list[schemas_user.UserPublic],
+    response_class=FastJSONResponse,
 )
 async def read_users(
-    session: SessionDep,
+    session: ReadSessionDep,
+    fields: UserFieldsDep,
+    user_filter: UserFilterDep,
     skip: Annotated[int, Query(ge=0)] = 0,
-    limit: Annotated[int | None, Query(gt=0)] = None,
+    limit: Annotated[
+        int, Query(gt=0, le=settings.MAX_PAGE_SIZE)
+    ] = settings.DEFAULT_PAGE_SIZE,
+    cursor: str | None = None,
+    total_count: Annotated[
+        bool,
+        Query(description="Return the number of the matching users in X-Total-Count."),
+    ] = False,
 ) -> Any:
     """
-    Retrieve users.
+    Retrieve the users matching the filters ordered by id, only with the given
+    `fields` if any.
+
+    If there are more users, the `X-Next-Cursor` response header contains a cursor
+    for the next page. Unlike `skip`, the cursor doesn't get slower deeper into the
+    table.
+
+    With `total_count` the number of the users matching the filters is returned in
+    the `X-Total-Count` header. Large totals can be estimated, which is indicated by
+    the `X-Total-Count-Estimated` header.
+    """
+    after_id = None
+    if cursor is not None:
+        try:
+            after_id = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
+    # The id is needed for the cursor, it's selected last to be left out if it's
+    # not requested
+    columns = fields if "id" in fields else fields + ("id",)
+    rows = await crud_user.get_users_rows(
+        session,
+        columns,
+        skip=skip,
+        limit=limit + 1,
+        after_id=after_id,
+        user_filter=user_filter,
+    )
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(rows[-1].id)
+    if total_count:
+        count, estimated = await crud_user.count_users(session, user_filter)
+        headers["X-Total-Count"] = str(count)
+        headers["X-Total-Count-Estimated"] = "true" if estimated else "false"
+    return FastJSONResponse(
+        get_user_serializer(fields).dump_json(rows), headers=headers
+    )
+
+
+@router.get(
+    "/export",
+    dependencies=[Depends(get_current_active_superuser)],
+    response_class=StreamingResponse,
+)
+async def export_users(
+    session: ReadSessionDep, format: Literal["ndjson", "csv"] = "ndjson"
+) -> StreamingResponse:
     """
-    statement = select(UserDB).offset(skip)
-    if limit:
-        statement = statement.limit(limit)
-    return list((await session.scalars(statement)).all())
+    Export all users as newline delimited JSON or CSV.
+    """
+    if format == "csv":
+        media_type, serialize = "text/csv", iter_csv
+    else:
+        media_type, serialize = "application/x-ndjson", iter_ndjson
+
+    async def content() -> AsyncIterator[str]:
+        # The session dependency is closed before the response body is sent, the
+        # session reconnects on the first query and must be closed here once again
+        try:
+            users = crud_user.stream_users(session, crud_user.USER_PUBLIC_COLUMNS)
+            serializer = get_user_serializer(crud_user.USER_PUBLIC_COLUMNS)
+            async for chunk in serialize(users, serializer):
+                yield chunk
+        finally:
+            await session.close()
+
+    return StreamingResponse(
+        content(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="users.{format}"'},
+    )
 
 
-@router.get("/{user_id}", response_model=schemas_user.UserPublic)
+@router.post(
+    "/bulk",
+    dependencies=[Depends(get_current_active_superuser)],
+    response_model=BulkResult[schemas_user.UserPublic],
+)
+async def create_users(
+    session: SessionDep,
+    users_in: Annotated[
+        list[schemas_user.UserCreate], Body(max_length=settings.BULK_MAX_ITEMS)
+    ],
+) -> Any:
+    """
+    Create users in bulk, the users which can't be created are reported in `errors`.
+    """
+    users, errors = await crud_user.create_users(session, users_in)
+    await crud_user.commit(session)
+    return {"succeeded": users, "errors": errors}
+
+
+@router.patch(
+    "/bulk",
+    dependencies=[Depends(get_current_active_superuser)],
+    response_model=BulkResult[schemas_user.UserPublic],
+)
+async def update_users(
+    session: SessionDep,
+    users_in: Annotated[
+        list[schemas_user.UserBulkUpdate], Body(max_length=settings.BULK_MAX_ITEMS)
+    ],
+) -> Any:
+    """
+    Update users in bulk, the users which can't be updated are reported in `errors`.
+    """
+    users, errors = await crud_user.update_users(session, users_in)
+    await crud_user.commit(session)
+    return {"succeeded": users, "errors": errors}
+
+
+@router.delete("/bulk", dependencies=[Depends(get_current_active_superuser)])
+async def delete_users(
+    session: SessionDep,
+    user_ids: Annotated[list[int], Body(max_length=settings.BULK_MAX_ITEMS)],
+) -> BulkResult[int]:
+    """
+    Delete users in bulk, the ids which weren't found are reported in `errors`.
+    """
+    deleted_ids, errors = await crud_user.delete_users(session, user_ids)
+    await crud_user.commit(session)
+    return BulkResult[int](succeeded=deleted_ids, errors=errors)
+
+
+@router.get(
+    "/{user_id}",
+    response_model=schemas_user.UserPublic,
+    response_class=FastJSONResponse,
+)
 async def read_user(
-    user_id: int, session: SessionDep, current_user: CurrentUser
+    user_id: int,
+    session: ReadSessionDep,
+    current_user: CurrentUserSnapshot,
+    fields: UserFieldsDep,
 ) -> Any:
     """
-    Get a specific user by id.
+    Get a specific user by id, only with the given `fields` if any.
     """
     if current_user.id != user_id and not current_user.is_superuser:
         raise HTTPException(
             status_code=403,
             detail="The user doesn't have enough privileges.",
         )
-    return await crud_user.get_user(session, user_id)
+    row = await crud_user.get_user_row(session, user_id, fields)
+    return FastJSONResponse(get_user_serializer(fields).dump_json_row(row))
 
 
 @router.post(
@@ -57,10 +251,8 @@ async def create_user(session: SessionDep, user_in: schemas_user.UserCreate) ->
     """
     Create a user.
     """
-    await crud_user.check_user_unique(session, user_in)
     user = await crud_user.create_user(session, user_in)
-    await session.commit()
-    await session.refresh(user)
+    await crud_user.commit(session)
     return user
 
 
@@ -70,21 +262,21 @@ async def delete_user(session: SessionDep, user_id: int) -> Message:
     Delete a user.
     """
     await crud_user.delete_user(session, user_id)
-    await session.commit()
+    await crud_user.commit(session)
     return Message(message="User deleted successfully.")
 
 
 @router.patch("/me", response_model=schemas_user.UserPublic)
 async def update_user_me(
-    session: SessionDep, user_in: schemas_user.UserUpdateMe, current_user: CurrentUser
+    session: SessionDep,
+    user_in: schemas_user.UserUpdateMe,
+    current_user: CurrentUserSnapshot,
 ) -> Any:
     """
     Update own user.
     """
-    await crud_user.check_user_unique(session, user_in, exclude_id=current_user.id)
     user = await crud_user.update_user(session, current_user.id, user_in)
-    await session.commit()
-    await session.refresh(user)
+    await crud_user.commit(session)
     return user
 
 
@@ -95,17 +287,20 @@ async def update_password_me(
     """
     Update own password.
     """
-    if not verify_password(body.current_password, current_user.hashed_password):
+    # The user is loaded, the connection isn't held while the passwords are hashed
+    await session.close()
+    verification = await password_hasher.verify_password(
+        body.current_password, current_user.hashed_password
+    )
+    if not verification.valid:
         raise HTTPException(status_code=400, detail="Incorrect password.")
     if body.current_password == body.new_password:
         raise HTTPException(
             status_code=400,
             detail="New password cannot be the same as the current one.",
         )
-    hashed_password = get_password_hash(body.new_password)
-    current_user.hashed_password = hashed_password
-    session.add(current_user)
-    await session.commit()
+    await crud_user.update_password(session, current_user, body.new_password)
+    await crud_user.commit(session)
     return Message(message="Password updated successfully.")
 
 
@@ -120,8 +315,6 @@ async def update_user(
     """
     Update a user.
     """
-    await crud_user.check_user_unique(session, user_in, exclude_id=user_id)
     user = await crud_user.update_user(session, user_id, user_in)
-    await session.commit()
-    await session.refresh(user)
+    await crud_user.commit(session)
     return user
@@ -0,0 +1,14 @@
+from fastapi import APIRouter, Depends
+
+from app.api.dependencies.auth import get_current_active_superuser
+from app.database import PoolStats, sessionmanager
+
+router = APIRouter()
+
+
+@router.get("/db-pool", dependencies=[Depends(get_current_active_superuser)])
+async def read_db_pool_stats() -> dict[str, PoolStats]:
+    """
+    Get the connection pool statistics of the current worker.
+    """
+    return sessionmanager.pool_stats()
@@ -0,0 +1,87 @@
+import argparse
+import json
+import logging
+import sys
+from pathlib import Path
+
+import anyio
+
+from app.benchmarks.api import SCENARIOS, run_benchmarks
+from app.benchmarks.utils import compare
+
+# Latencies depend on the machine, so the baseline is saved locally with
+# --save-baseline and isn't committed
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.benchmarks",
+        description="Benchmark the API endpoints in-process against a new database.",
+    )
+    parser.add_argument("--database", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=list(SCENARIOS),
+        help="Scenario to run, can be repeated. All scenarios are run by default.",
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store the results as the baseline instead of comparing against it.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed p95 latency growth over the baseline, as a fraction.",
+    )
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    logging.disable(logging.INFO)
+    results = anyio.run(
+        run_benchmarks,
+        args.database,
+        args.scenario or list(SCENARIOS),
+        args.users,
+        args.concurrency,
+    )
+
+    print(
+        f"{'scenario':<20}{'requests':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        f"{'rps':>10}{'queries':>10}"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:<20}{result.requests:>10}{result.p50:>10.2f}{result.p95:>10.2f}"
+            f"{result.p99:>10.2f}{result.rps:>10.1f}{result.queries_per_request:>10.2f}"
+        )
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    if args.save_baseline:
+        baseline[args.database] = {
+            name: result.to_dict() for name, result in results.items()
+        }
+        args.baseline.write_text(json.dumps(baseline, indent=2) + "\n")
+        return 0
+    if args.database not in baseline:
+        print(
+            f"No {args.database} baseline in {args.baseline}, save one with "
+            "--save-baseline to compare against it."
+        )
+        return 0
+    regressions = compare(results, baseline[args.database], args.tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
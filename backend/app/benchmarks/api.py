@@ -0,0 +1,217 @@
+import contextlib
+import itertools
+import tempfile
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Literal
+
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import insert, select
+
+from app.api.dependencies.db import (
+    SessionDep,
+    get_db_primary_read_session,
+    get_db_read_session,
+    get_session_factory,
+)
+from app.benchmarks.utils import BenchmarkResult, measure
+from app.config import settings
+from app.database import (
+    Base,
+    DatabaseSessionManager,
+    LazySession,
+    get_db_session,
+    get_engine_kwargs,
+)
+from app.initial_data import init_db
+from app.main import app
+from app.models.user import UserDB
+from app.utils.auth import get_password_hash
+from app.utils.pagination import encode_cursor
+
+Database = Literal["sqlite", "postgres"]
+
+USER_PASSWORD = "benchmark-password"
+LIST_LIMIT = 50
+
+
+@dataclass
+class Context:
+    client: AsyncClient
+    superuser_headers: dict[str, str]
+    user_headers: dict[str, str]
+    user_id: int
+    # Cursor of the last full page of the users list
+    last_page_cursor: str
+
+
+@dataclass(frozen=True)
+class Scenario:
+    request: Callable[[Context, int], Awaitable[None]]
+    requests: int
+
+
+async def login(context: Context, number: int) -> None:
+    # Different users, so that the login rate limit per username isn't hit
+    data = {"username": f"user{number}@example.com", "password": USER_PASSWORD}
+    r = await context.client.post(
+        f"{settings.API_V1_STR}/login/access-token", data=data
+    )
+    r.raise_for_status()
+
+
+async def read_user(context: Context, number: int) -> None:
+    r = await context.client.get(
+        f"{settings.API_V1_STR}/users/{context.user_id}", headers=context.user_headers
+    )
+    r.raise_for_status()
+
+
+async def list_users(context: Context, number: int) -> None:
+    r = await context.client.get(
+        f"{settings.API_V1_STR}/users/",
+        headers=context.superuser_headers,
+        params={"limit": LIST_LIMIT},
+    )
+    r.raise_for_status()
+
+
+async def list_users_cursor(context: Context, number: int) -> None:
+    r = await context.client.get(
+        f"{settings.API_V1_STR}/users/",
+        headers=context.superuser_headers,
+        params={"limit": LIST_LIMIT, "cursor": context.last_page_cursor},
+    )
+    r.raise_for_status()
+
+
+async def update_user_me(context: Context, number: int) -> None:
+    r = await context.client.patch(
+        f"{settings.API_V1_STR}/users/me",
+        headers=context.user_headers,
+        json={"first_name": f"Name {number}"},
+    )
+    r.raise_for_status()
+
+
+SCENARIOS = {
+    "login": Scenario(login, requests=20),
+    "read_user": Scenario(read_user, requests=500),
+    "list_users": Scenario(list_users, requests=200),
+    "list_users_cursor": Scenario(list_users_cursor, requests=200),
+    "update_user_me": Scenario(update_user_me, requests=200),
+}
+
+
+@contextlib.asynccontextmanager
+async def database_url(database: Database) -> AsyncIterator[str]:
+    if database == "sqlite":
+        # A file rather than :memory:, so that concurrent requests use their own
+        # connections like they would with a server.
+        with tempfile.TemporaryDirectory() as directory:
+            yield f"sqlite+aiosqlite:///{directory}/benchmark.db"
+        return
+    import testing.postgresql
+
+    with testing.postgresql.Postgresql() as postgresql:
+        yield postgresql.url().replace("postgresql://", "postgresql+asyncpg://")
+
+
+async def create_users(manager: DatabaseSessionManager, count: int) -> None:
+    hashed_password = get_password_hash(USER_PASSWORD)
+    async with manager.session() as session:
+        await init_db(session)
+        await session.execute(
+            insert(UserDB),
+            [
+                {
+                    "username": f"user{index}@example.com",
+                    "email": f"user{index}@example.com",
+                    "hashed_password": hashed_password,
+                }
+                for index in range(count)
+            ],
+        )
+        await session.commit()
+
+
+@contextlib.asynccontextmanager
+async def benchmark_context(database: Database, users: int) -> AsyncIterator[Context]:
+    """Run the app in-process against a new database with `users` users."""
+    async with database_url(database) as url:
+        manager = DatabaseSessionManager(url, get_engine_kwargs(url))
+        async with manager.connection() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        await create_users(manager, users)
+
+        async def get_session() -> AsyncIterator[LazySession]:
+            async with manager.lazy_session() as session:
+                yield session
+
+        async def get_read_session(session: SessionDep) -> AsyncIterator[LazySession]:
+            async with manager.read_session(session) as read_session:
+                yield read_session
+
+        async def get_primary_read_session(
+            session: SessionDep,
+        ) -> AsyncIterator[LazySession]:
+            async with manager.read_session(session, use_replica=False) as read_session:
+                yield read_session
+
+        app.dependency_overrides[get_db_session] = get_session
+        app.dependency_overrides[get_db_read_session] = get_read_session
+        app.dependency_overrides[get_db_primary_read_session] = get_primary_read_session
+        app.dependency_overrides[get_session_factory] = lambda: manager.session
+        transport = ASGITransport(app=app)  # type: ignore
+        async with AsyncClient(transport=transport, base_url="http://test") as client:
+            headers = []
+            for username, password in (
+                (settings.FIRST_SUPERUSER, settings.FIRST_SUPERUSER_PASSWORD),
+                ("user0@example.com", USER_PASSWORD),
+            ):
+                r = await client.post(
+                    f"{settings.API_V1_STR}/login/access-token",
+                    data={"username": username, "password": password},
+                )
+                r.raise_for_status()
+                headers.append({"Authorization": f"Bearer {r.json()['access_token']}"})
+            async with manager.session() as session:
+                user_id = (
+                    await session.execute(
+                        select(UserDB.id).where(UserDB.username == "user0@example.com")
+                    )
+                ).scalar_one()
+                # The superuser is seeded too, so there are `users` + 1 rows
+                last_page_after_id = (
+                    await session.execute(
+                        select(UserDB.id)
+                        .order_by(UserDB.id)
+                        .offset(max(users - LIST_LIMIT, 0))
+                        .limit(1)
+                    )
+                ).scalar_one()
+            superuser_headers, user_headers = headers
+            yield Context(
+                client,
+                superuser_headers,
+                user_headers,
+                user_id,
+                encode_cursor(last_page_after_id),
+            )
+        app.dependency_overrides.clear()
+        await manager.close()
+
+
+async def run_benchmarks(
+    database: Database, scenarios: list[str], users: int, concurrency: int
+) -> dict[str, BenchmarkResult]:
+    results = {}
+    async with benchmark_context(database, users) as context:
+        for name in scenarios:
+            scenario = SCENARIOS[name]
+            counter = itertools.count()
+
+            async def request(number: int) -> None:
+                await scenario.request(context, next(counter))
+
+            results[name] = await measure(request, scenario.requests, concurrency)
+    return results
@@ -0,0 +1,94 @@
+import statistics
+import time
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable
+
+import anyio
+
+from app.instrumentation import track_queries
+
+# Cache hits depend on how concurrent requests interleave, so the number of queries
+# per request varies a bit between runs. An extra query in every request doesn't fit.
+QUERIES_PER_REQUEST_TOLERANCE = 0.5
+
+
+@dataclass(frozen=True)
+class BenchmarkResult:
+    requests: int
+    p50: float
+    p95: float
+    p99: float
+    rps: float
+    queries_per_request: float
+
+    def to_dict(self) -> dict[str, float]:
+        return {name: round(value, 2) for name, value in asdict(self).items()}
+
+
+def percentile(latencies: list[float], percent: int) -> float:
+    if len(latencies) == 1:
+        return latencies[0]
+    return statistics.quantiles(latencies, n=100, method="inclusive")[percent - 1]
+
+
+async def measure(
+    request: Callable[[int], Awaitable[None]],
+    requests: int,
+    concurrency: int,
+) -> BenchmarkResult:
+    """Call `request` with the numbers of the requests, running `concurrency` of them
+    at the same time, and collect the latencies in milliseconds.
+    """
+    latencies: list[float] = []
+    limiter = anyio.CapacityLimiter(concurrency)
+
+    async def timed_request(number: int) -> None:
+        async with limiter:
+            start = time.perf_counter()
+            await request(number)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    with track_queries() as stats:
+        start = time.perf_counter()
+        async with anyio.create_task_group() as task_group:
+            for number in range(requests):
+                task_group.start_soon(timed_request, number)
+        elapsed = time.perf_counter() - start
+    return BenchmarkResult(
+        requests=requests,
+        p50=percentile(latencies, 50),
+        p95=percentile(latencies, 95),
+        p99=percentile(latencies, 99),
+        rps=requests / elapsed,
+        queries_per_request=stats.count / requests,
+    )
+
+
+def compare(
+    results: dict[str, BenchmarkResult],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float,
+) -> list[str]:
+    """Return the regressions of the results against the baseline.
+
+    Latency may grow within `tolerance` (a fraction) to allow for noise, while the
+    number of queries per request may only vary by cache hits.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result.p95 > expected["p95"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {result.p95:.2f} ms > {expected['p95']:.2f} ms"
+            )
+        if (
+            result.queries_per_request
+            > expected["queries_per_request"] + QUERIES_PER_REQUEST_TOLERANCE
+        ):
+            regressions.append(
+                f"{name}: {result.queries_per_request:.2f} queries per request > "
+                f"{expected['queries_per_request']:.2f}"
+            )
+    return regressions
@@ -0,0 +1,143 @@
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Generic, Hashable, TypeVar
+
+from app.config import settings
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLLRUCache(Generic[K, V]):
+    """In-process mapping bounded by size, evicting expired and least recently used
+    entries first.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None) -> None:
+        if maxsize <= 0:
+            raise ValueError("Cache maxsize must be positive.")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[K, tuple[float | None, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K) -> V | None:
+        try:
+            expires_at, value = self._data[key]
+        except KeyError:
+            return None
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: K) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class CacheBackend(ABC):
+    """Storage used by `Cache`.
+
+    The in-memory backend is local to a worker process. A backend on top of a shared
+    store (e.g. Redis) makes entries and invalidations visible to all workers.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Any | None: ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Any) -> None: ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None: ...
+
+    @abstractmethod
+    async def clear(self) -> None: ...
+
+
+class InMemoryCacheBackend(CacheBackend):
+    def __init__(self, maxsize: int, ttl: float | None = None) -> None:
+        self._cache: TTLLRUCache[str, Any] = TTLLRUCache(maxsize, ttl)
+
+    async def get(self, key: str) -> Any | None:
+        return self._cache.get(key)
+
+    async def set(self, key: str, value: Any) -> None:
+        self._cache.set(key, value)
+
+    async def delete(self, key: str) -> None:
+        self._cache.pop(key)
+
+    async def clear(self) -> None:
+        self._cache.clear()
+
+
+class Cache:
+    """Namespaced cache, `backend` can be replaced to share it between workers.
+
+    A value read from the DB before an invalidation must not be stored after it, so
+    the readers take the `generation` before the read and pass it to `set`. The
+    generation counts the invalidations of this worker only.
+    """
+
+    def __init__(self, namespace: str, backend: CacheBackend) -> None:
+        self.namespace = namespace
+        self.backend = backend
+        self.generation = 0
+
+    def _key(self, key: Hashable) -> str:
+        return f"{self.namespace}:{key}"
+
+    async def get(self, key: Hashable) -> Any | None:
+        return await self.backend.get(self._key(key))
+
+    async def set(
+        self, key: Hashable, value: Any, generation: int | None = None
+    ) -> None:
+        """Store the value, unless an entry has been invalidated since `generation`
+        was taken, in which case the value may be stale.
+        """
+        if generation is not None and generation != self.generation:
+            return
+        await self.backend.set(self._key(key), value)
+
+    async def delete(self, key: Hashable) -> None:
+        self.generation += 1
+        await self.backend.delete(self._key(key))
+
+    async def clear(self) -> None:
+        self.generation += 1
+        await self.backend.clear()
+
+
+user_cache = Cache(
+    "user",
+    InMemoryCacheBackend(
+        maxsize=settings.USER_CACHE_MAX_SIZE, ttl=settings.USER_CACHE_TTL_SECONDS
+    ),
+)
+
+# Entries live as long as the refresh tokens are valid. With the in-memory backend a
+# token reused on another worker is not detected.
+used_refresh_tokens = Cache(
+    "refresh_token",
+    InMemoryCacheBackend(
+        maxsize=settings.USED_REFRESH_TOKENS_MAX_SIZE,
+        ttl=settings.REFRESH_TOKEN_EXPIRE_MINUTES * 60,
+    ),
+)
@@ -1,4 +1,5 @@
 import secrets
+from typing import Literal
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -9,15 +10,72 @@ class Settings(BaseSettings):
     )
 
     DATABASE_URL: str
+    # Every worker has its own pool, so workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+    # must stay below max_connections of Postgres. Not applied to SQLite.
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    # Size of the prepared statement cache of every asyncpg connection
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    # Logs every statement, too slow for production. Per-request totals are always
+    # logged and requests repeating a statement that many times are reported as N+1
+    DB_ECHO: bool = False
+    DB_N_PLUS_ONE_THRESHOLD: int = 5
+    # Read-only queries are spread over the healthy replicas, if there are any
+    DATABASE_REPLICA_URLS: list[str] = []
+    DB_REPLICA_HEALTH_CHECK_INTERVAL: float = 10
     SECRET_KEY: str = secrets.token_urlsafe(32)
     API_V1_STR: str = "/api/v1"
     FIRST_SUPERUSER: str
     FIRST_SUPERUSER_PASSWORD: str
     EMAIL_TEST_USER: str = "test.user@gmail.com"
+    # Access tokens are short-lived, sessions are kept alive with refresh tokens
+    ACCESS_TOKEN_EXPIRE_MINUTES: int = 15
     # 60 minutes * 24 hours * 8 days = 8 days
-    ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 8
+    REFRESH_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 8
+    # Ids of the rotated refresh tokens are kept in memory to detect their reuse
+    USED_REFRESH_TOKENS_MAX_SIZE: int = 100_000
+    # Verified tokens are cached until they expire to skip the signature check
+    TOKEN_CACHE_MAX_SIZE: int = 10_000
+    # Login attempts allowed per username and per client IP in a period, with
+    # bursts up to the same numbers
+    LOGIN_RATE_LIMIT_USERNAME_ATTEMPTS: int = 10
+    LOGIN_RATE_LIMIT_IP_ATTEMPTS: int = 100
+    LOGIN_RATE_LIMIT_PERIOD_SECONDS: float = 60
+    RATE_LIMIT_MAX_KEYS: int = 100_000
+    # Role claims of the access tokens spare the DB lookup of the user until they
+    # expire, so this is also the delay of revocations. 0 (the default) disables the
+    # claims, revocations then take effect at once
+    ACCESS_TOKEN_CLAIMS_EXPIRE_SECONDS: int = 0
     PROJECT_NAME: str = "Async FastAPI SQLAlchemy Project"
     LOG_LEVEL: str = "DEBUG"
+    LOG_FORMAT: Literal["json", "text"] = "json"
+    # Records are written by a background thread, the ones exceeding the queue size
+    # are dropped (see the log_records_dropped metric)
+    LOG_QUEUE_SIZE: int = 10_000
+    # bcrypt is CPU bound, so it runs in a bounded pool of threads or processes
+    PASSWORD_HASHING_EXECUTOR: Literal["thread", "process"] = "thread"
+    PASSWORD_HASHING_MAX_WORKERS: int = 4
+    # Hashes of other algorithms or work factors are upgraded on login.
+    # argon2 requires argon2-cffi
+    PASSWORD_HASHING_ALGORITHM: Literal["bcrypt", "argon2"] = "bcrypt"
+    BCRYPT_ROUNDS: int = 12
+    ARGON2_TIME_COST: int = 3
+    ARGON2_MEMORY_COST: int = 64 * 1024
+    ARGON2_PARALLELISM: int = 4
+    # Authenticated users are cached to skip the DB lookup on every request
+    USER_CACHE_TTL_SECONDS: float = 60
+    USER_CACHE_MAX_SIZE: int = 10_000
+    DEFAULT_PAGE_SIZE: int = 100
+    MAX_PAGE_SIZE: int = 1000
+    # Total counts of the lists are exact up to this number of rows, larger ones are
+    # estimated from the planner statistics on PostgreSQL
+    TOTAL_COUNT_EXACT_LIMIT: int = 10_000
+    # Limits for the batch endpoints, rows are written in chunks of BULK_CHUNK_SIZE
+    BULK_MAX_ITEMS: int = 10_000
+    BULK_CHUNK_SIZE: int = 1000
 
 
 settings = Settings()  # type: ignore
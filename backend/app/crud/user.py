@@ -1,48 +1,111 @@
+from typing import Any, AsyncIterator, Container, Sequence, TypeVar
+
 from fastapi import HTTPException
-from sqlalchemy import select
+from sqlalchemy import Row, Select, delete, event, func, insert, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, SessionTransaction
 
 import app.schemas.user as schemas_user
-from app.crud.utils import is_object_unique
+from app.cache import user_cache
+from app.config import settings
+from app.crud.utils import (
+    chunked,
+    estimate_rows,
+    estimate_table_rows,
+    get_unique_values_owners,
+    starts_with,
+    unique_violation_handler,
+)
+from app.metrics import timed_crud
 from app.models.user import UserDB
-from app.utils.auth import get_password_hash, verify_password
+from app.schemas.bulk import BulkError
+from app.utils.auth import password_hasher
 
+T = TypeVar("T", bound=Any)
 
-async def check_user_unique(
-    session: AsyncSession,
-    user_in: schemas_user.UserBase | schemas_user.UserUpdateMe,
-    exclude_id: int | None = None,
+USER_EXISTS_DETAIL = "The user with the given email or username already exists."
+USER_UNIQUE_FIELDS = ("email", "username")
+# Changes of the fields embedded in the access tokens revoke the tokens of the user
+USER_TOKEN_CLAIM_FIELDS = ("is_active", "is_superuser")
+# Column sets of the read-only queries. Their results are plain rows, which are
+# cheaper to build than the ORM objects and aren't tracked by the session.
+USER_PUBLIC_COLUMNS = tuple(schemas_user.UserPublic.model_fields)
+USER_SNAPSHOT_COLUMNS = tuple(schemas_user.UserSnapshot.model_fields)
+USER_AUTH_COLUMNS = USER_SNAPSHOT_COLUMNS + ("hashed_password",)
+
+
+# Ids of the users changed in the transaction of the session, see `commit`
+_INVALIDATED_USERS_KEY = "invalidated_users"
+
+
+def _invalidate_cached_users(session: AsyncSession, *user_ids: int) -> None:
+    session.info.setdefault(_INVALIDATED_USERS_KEY, set()).update(user_ids)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_invalidated_users(
+    session: Session, previous_transaction: SessionTransaction
 ) -> None:
-    if not await is_user_unique(session, user_in, exclude_id):
-        raise HTTPException(
-            status_code=400,
-            detail="The user with the given email or username already exists.",
-        )
+    if not previous_transaction.nested:
+        session.info.pop(_INVALIDATED_USERS_KEY, None)
 
 
-async def is_user_unique(
-    session: AsyncSession,
-    user_in: schemas_user.UserBase | schemas_user.UserUpdateMe,
-    exclude_id: int | None = None,
-) -> bool:
-    return await is_object_unique(
-        session,
-        UserDB,
-        user_in,
-        unique_fields=("email", "username"),
-        exclude_id=exclude_id,
-    )
+async def commit(session: AsyncSession) -> None:
+    """Commit the session, then drop the users changed in it from the user cache.
+
+    Dropping them before the commit would let a concurrent request read the old rows
+    and cache them again until the entries expire.
+    """
+    try:
+        await session.commit()
+    finally:
+        user_ids = session.info.pop(_INVALIDATED_USERS_KEY, set())
+    for user_id in user_ids:
+        await user_cache.delete(user_id)
+
+
+def _select_columns(columns: Sequence[str]) -> Select[Any]:
+    return select(*(getattr(UserDB, column) for column in columns))
 
 
+@timed_crud
 async def authenticate(
-    session: AsyncSession, username: str, password: str
-) -> UserDB | None:
-    db_user = await get_user_by_username(session, username)
-    if not (db_user and verify_password(password, db_user.hashed_password)):
+    session: AsyncSession,
+    username: str,
+    password: str,
+) -> tuple[Row[Any], bool] | None:
+    """Return the `USER_AUTH_COLUMNS` of the user if the password is correct, and
+    whether the password hash needs to be upgraded.
+    """
+    db_user = await get_user_row_by_unique_field(
+        session, "username", username, USER_AUTH_COLUMNS
+    )
+    if not db_user:
+        await password_hasher.verify_dummy_password(password)
+        return None
+    verification = await password_hasher.verify_password(
+        password, db_user.hashed_password
+    )
+    if not verification.valid:
         return None
-    return db_user
+    return db_user, verification.needs_rehash
 
 
+@timed_crud
+async def rehash_password(
+    session: AsyncSession, user_id: int, hashed_password: str, password: str
+) -> None:
+    """Replace the hash with one of the current algorithm and work factor, unless
+    the password has been changed meanwhile.
+    """
+    await session.execute(
+        update(UserDB)
+        .where(UserDB.id == user_id, UserDB.hashed_password == hashed_password)
+        .values(hashed_password=await password_hasher.get_password_hash(password))
+    )
+
+
+@timed_crud
 async def get_user(session: AsyncSession, user_id: int) -> UserDB:
     user = await session.get(UserDB, user_id)
     if not user:
@@ -50,6 +113,143 @@ async def get_user(session: AsyncSession, user_id: int) -> UserDB:
     return user
 
 
+def _paginate_users(
+    statement: Select[T], skip: int, limit: int | None, after_id: int | None
+) -> Select[T]:
+    statement = statement.order_by(UserDB.id)
+    if after_id is not None:
+        statement = statement.where(UserDB.id > after_id)
+    if skip:
+        statement = statement.offset(skip)
+    if limit:
+        statement = statement.limit(limit)
+    return statement
+
+
+def _filter_users(
+    statement: Select[T], user_filter: schemas_user.UserFilter
+) -> Select[T]:
+    # The bare boolean columns are rendered as the predicates of the partial indexes
+    if user_filter.is_active is not None:
+        statement = statement.where(
+            UserDB.is_active if user_filter.is_active else ~UserDB.is_active
+        )
+    if user_filter.is_superuser is not None:
+        statement = statement.where(
+            UserDB.is_superuser if user_filter.is_superuser else ~UserDB.is_superuser
+        )
+    if user_filter.username_prefix:
+        statement = statement.where(
+            starts_with(UserDB.username, user_filter.username_prefix)
+        )
+    if user_filter.email_prefix:
+        statement = statement.where(starts_with(UserDB.email, user_filter.email_prefix))
+    return statement
+
+
+@timed_crud
+async def get_user_row(
+    session: AsyncSession, user_id: int, columns: Sequence[str] = USER_PUBLIC_COLUMNS
+) -> Row[Any]:
+    """Read-only version of `get_user` selecting only the given columns."""
+    row = (
+        await session.execute(_select_columns(columns).where(UserDB.id == user_id))
+    ).one_or_none()
+    if row is None:
+        raise HTTPException(status_code=404, detail="User not found.")
+    return row
+
+
+@timed_crud
+async def get_users_rows(
+    session: AsyncSession,
+    columns: Sequence[str],
+    skip: int = 0,
+    limit: int | None = None,
+    after_id: int | None = None,
+    user_filter: schemas_user.UserFilter | None = None,
+) -> Sequence[Row[Any]]:
+    """Return the given columns of the users matching `user_filter` ordered by id,
+    `after_id` is the keyset alternative to `skip`.
+    """
+    statement = _select_columns(columns)
+    if user_filter is not None:
+        statement = _filter_users(statement, user_filter)
+    statement = _paginate_users(statement, skip, limit, after_id)
+    return (await session.execute(statement)).all()
+
+
+@timed_crud
+async def count_users(
+    session: AsyncSession, user_filter: schemas_user.UserFilter | None = None
+) -> tuple[int, bool]:
+    """Count the users matching `user_filter`, return the count and whether it's
+    estimated.
+
+    Counting reads every matching row, so on PostgreSQL only up to
+    `TOTAL_COUNT_EXACT_LIMIT` rows are counted. Larger totals are estimated by the
+    planner: from `pg_class.reltuples` for all users, from the query plan for the
+    filtered ones. Other DBs have no such statistics, their counts are always exact.
+    """
+    statement = select(UserDB.id)
+    if user_filter is not None:
+        statement = _filter_users(statement, user_filter)
+    if session.get_bind().dialect.name != "postgresql":
+        count = (
+            await session.execute(
+                select(func.count()).select_from(statement.subquery())
+            )
+        ).scalar_one()
+        return count, False
+
+    limit = settings.TOTAL_COUNT_EXACT_LIMIT
+    if statement.whereclause is None:
+        estimate = await estimate_table_rows(session, UserDB)
+        if estimate is not None and estimate > limit:
+            return estimate, True
+    count = (
+        await session.execute(
+            select(func.count()).select_from(statement.limit(limit + 1).subquery())
+        )
+    ).scalar_one()
+    if count <= limit:
+        return count, False
+    # The estimate can be off, but the total is known to be above the limit
+    return max(await estimate_rows(session, statement), limit + 1), True
+
+
+async def stream_users(
+    session: AsyncSession,
+    columns: Sequence[str] = USER_PUBLIC_COLUMNS,
+    batch_size: int = 1000,
+) -> AsyncIterator[Row[Any]]:
+    """Iterate over the given columns of all users ordered by id, fetching them from
+    a server-side cursor in batches instead of loading the whole table.
+    """
+    result = await session.stream(
+        _select_columns(columns)
+        .order_by(UserDB.id)
+        .execution_options(yield_per=batch_size)
+    )
+    async for row in result:
+        yield row
+
+
+@timed_crud
+async def get_user_snapshot(
+    session: AsyncSession, user_id: int
+) -> schemas_user.UserSnapshot:
+    snapshot = await user_cache.get(user_id)
+    if snapshot is None:
+        generation = user_cache.generation
+        snapshot = schemas_user.UserSnapshot.model_validate(
+            await get_user_row(session, user_id, USER_SNAPSHOT_COLUMNS)
+        )
+        await user_cache.set(user_id, snapshot, generation)
+    return snapshot
+
+
+@timed_crud
 async def get_user_by_unique_field(
     session: AsyncSession, field: str, value: str
 ) -> UserDB | None:
@@ -58,35 +258,238 @@ async def get_user_by_unique_field(
     ).one_or_none()
 
 
+@timed_crud
+async def get_user_row_by_unique_field(
+    session: AsyncSession,
+    field: str,
+    value: str,
+    columns: Sequence[str] = USER_PUBLIC_COLUMNS,
+) -> Row[Any] | None:
+    """Read-only version of `get_user_by_unique_field` selecting only the given
+    columns.
+    """
+    return (
+        await session.execute(
+            _select_columns(columns).where(getattr(UserDB, field) == value)
+        )
+    ).one_or_none()
+
+
+@timed_crud
 async def get_user_by_email(session: AsyncSession, email: str) -> UserDB | None:
     return await get_user_by_unique_field(session, "email", email)
 
 
+@timed_crud
 async def get_user_by_username(session: AsyncSession, username: str) -> UserDB | None:
     return await get_user_by_unique_field(session, "username", username)
 
 
+@timed_crud
 async def create_user(
     session: AsyncSession, user_in: schemas_user.UserCreate
 ) -> UserDB:
     db_obj = UserDB(
         **user_in.model_dump(exclude={"password"}),
-        hashed_password=get_password_hash(user_in.password)
+        hashed_password=await password_hasher.get_password_hash(user_in.password),
     )
     session.add(db_obj)
+    with unique_violation_handler(UserDB, USER_EXISTS_DETAIL):
+        await session.flush()
     return db_obj
 
 
+@timed_crud
 async def delete_user(session: AsyncSession, user_id: int) -> None:
-    await session.delete(await get_user(session, user_id))
+    deleted_id = await session.scalar(
+        delete(UserDB).where(UserDB.id == user_id).returning(UserDB.id)
+    )
+    if deleted_id is None:
+        raise HTTPException(status_code=404, detail="User not found.")
+    _invalidate_cached_users(session, user_id)
 
 
+@timed_crud
 async def update_user(
     session: AsyncSession,
     user_id: int,
     user_in: schemas_user.UserUpdate | schemas_user.UserUpdateMe,
 ) -> UserDB:
-    user = await get_user(session, user_id)
-    for key, value in user_in.model_dump(exclude_unset=True).items():
-        setattr(user, key, value)
+    values = user_in.model_dump(exclude_unset=True)
+    if not values:
+        return await get_user(session, user_id)
+    if values.keys() & set(USER_TOKEN_CLAIM_FIELDS):
+        values["token_version"] = UserDB.token_version + 1
+    with unique_violation_handler(UserDB, USER_EXISTS_DETAIL):
+        user = await session.scalar(
+            update(UserDB)
+            .where(UserDB.id == user_id)
+            .values(**values)
+            .returning(UserDB)
+            .execution_options(populate_existing=True)
+        )
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found.")
+    _invalidate_cached_users(session, user_id)
     return user
+
+
+@timed_crud
+async def revoke_tokens(session: AsyncSession, user_id: int) -> None:
+    """Revoke all access and refresh tokens of the user."""
+    await session.execute(
+        update(UserDB)
+        .where(UserDB.id == user_id)
+        .values(token_version=UserDB.token_version + 1)
+    )
+    _invalidate_cached_users(session, user_id)
+
+
+@timed_crud
+async def update_password(session: AsyncSession, user: UserDB, password: str) -> None:
+    user.hashed_password = await password_hasher.get_password_hash(password)
+    user.token_version += 1
+    session.add(user)
+    _invalidate_cached_users(session, user.id)
+
+
+def _find_unique_conflicts(
+    users_in: Sequence[schemas_user.UserBase | schemas_user.UserBulkUpdate],
+    owners: dict[str, dict[str, int]],
+    skip: Container[int] = (),
+) -> list[BulkError]:
+    """Find the users whose unique values are owned by other users in the DB or are
+    repeated in the batch. The users at the `skip` indexes are left out.
+    """
+    errors = []
+    seen: dict[str, set[str]] = {field: set() for field in USER_UNIQUE_FIELDS}
+    for index, user_in in enumerate(users_in):
+        if index in skip:
+            continue
+        user_id = getattr(user_in, "id", None)
+        values = {
+            field: value
+            for field in USER_UNIQUE_FIELDS
+            if (value := getattr(user_in, field)) is not None
+        }
+        if any(
+            owners[field].get(value, user_id) != user_id or value in seen[field]
+            for field, value in values.items()
+        ):
+            errors.append(BulkError(index=index, detail=USER_EXISTS_DETAIL))
+            continue
+        for field, value in values.items():
+            seen[field].add(value)
+    return errors
+
+
+@timed_crud
+async def create_users(
+    session: AsyncSession, users_in: Sequence[schemas_user.UserCreate]
+) -> tuple[list[UserDB], list[BulkError]]:
+    """Insert the users which don't violate uniqueness with multi-row INSERT ...
+    RETURNING statements, the rest are returned as errors.
+    """
+    # Hashed before the first query, so that no connection is held idle in the
+    # transaction while the whole batch is hashed
+    hashed_passwords = await password_hasher.get_password_hashes(
+        [user_in.password for user_in in users_in]
+    )
+    owners = await get_unique_values_owners(
+        session, UserDB, users_in, USER_UNIQUE_FIELDS
+    )
+    errors = _find_unique_conflicts(users_in, owners)
+    failed = {error.index for error in errors}
+    rows = [
+        {**user_in.model_dump(exclude={"password"}), "hashed_password": hashed}
+        for index, (user_in, hashed) in enumerate(zip(users_in, hashed_passwords))
+        if index not in failed
+    ]
+    users: list[UserDB] = []
+    statement = insert(UserDB).returning(UserDB, sort_by_parameter_order=True)
+    # The batch is checked upfront, this only catches the concurrent writes
+    with unique_violation_handler(UserDB, USER_EXISTS_DETAIL):
+        for rows_chunk in chunked(rows, settings.BULK_CHUNK_SIZE):
+            users.extend(await session.scalars(statement, rows_chunk))
+    return users, errors
+
+
+@timed_crud
+async def update_users(
+    session: AsyncSession, users_in: Sequence[schemas_user.UserBulkUpdate]
+) -> tuple[list[UserDB], list[BulkError]]:
+    """Update the users by primary key with executemany UPDATE statements, missing
+    users and uniqueness violations are returned as errors.
+    """
+    user_ids = [user_in.id for user_in in users_in]
+    found_ids: set[int] = set()
+    for ids_chunk in chunked(user_ids, settings.BULK_CHUNK_SIZE):
+        found_ids.update(
+            await session.scalars(select(UserDB.id).where(UserDB.id.in_(ids_chunk)))
+        )
+    errors = [
+        BulkError(index=index, detail="User not found.")
+        for index, user_id in enumerate(user_ids)
+        if user_id not in found_ids
+    ]
+    # The values of the missing users must not conflict with the rest of the batch
+    missing = {error.index for error in errors}
+    owners = await get_unique_values_owners(
+        session,
+        UserDB,
+        [user_in for user_in in users_in if user_in.id in found_ids],
+        USER_UNIQUE_FIELDS,
+    )
+    errors.extend(_find_unique_conflicts(users_in, owners, skip=missing))
+    failed = {error.index for error in errors}
+    rows = [
+        user_in.model_dump(exclude_unset=True) | {"id": user_in.id}
+        for index, user_in in enumerate(users_in)
+        if index not in failed
+    ]
+    users: list[UserDB] = []
+    for rows_chunk in chunked(rows, settings.BULK_CHUNK_SIZE):
+        chunk_ids = [row["id"] for row in rows_chunk]
+        revoked_ids = [
+            row["id"] for row in rows_chunk if row.keys() & set(USER_TOKEN_CLAIM_FIELDS)
+        ]
+        with unique_violation_handler(UserDB, USER_EXISTS_DETAIL):
+            await session.execute(update(UserDB), rows_chunk)
+        # Incremented by the DB like in `update_user`, a version read earlier could
+        # undo a concurrent revocation
+        if revoked_ids:
+            await session.execute(
+                update(UserDB)
+                .where(UserDB.id.in_(revoked_ids))
+                .values(token_version=UserDB.token_version + 1)
+            )
+        users.extend(
+            await session.scalars(
+                select(UserDB)
+                .where(UserDB.id.in_(chunk_ids))
+                .order_by(UserDB.id)
+                .execution_options(populate_existing=True)
+            )
+        )
+        _invalidate_cached_users(session, *chunk_ids)
+    return users, sorted(errors, key=lambda error: error.index)
+
+
+@timed_crud
+async def delete_users(
+    session: AsyncSession, user_ids: Sequence[int]
+) -> tuple[list[int], list[BulkError]]:
+    deleted_ids: set[int] = set()
+    for ids_chunk in chunked(user_ids, settings.BULK_CHUNK_SIZE):
+        deleted_ids.update(
+            await session.scalars(
+                delete(UserDB).where(UserDB.id.in_(ids_chunk)).returning(UserDB.id)
+            )
+        )
+    _invalidate_cached_users(session, *deleted_ids)
+    errors = [
+        BulkError(index=index, detail="User not found.")
+        for index, user_id in enumerate(user_ids)
+        if user_id not in deleted_ids
+    ]
+    return sorted(deleted_ids), errors
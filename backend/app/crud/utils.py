@@ -1,30 +1,214 @@
-from typing import Any, Mapping
+import contextlib
+import json
+from typing import Any, Iterator, Mapping, Sequence, TypeVar
 
+from fastapi import HTTPException
 from pydantic import BaseModel
+from sqlalchemy import Index, Select, UniqueConstraint, bindparam, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.future import select
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy.sql import exists, or_
+from sqlalchemy.sql import or_
+from sqlalchemy.sql.base import Executable
+from sqlalchemy.sql.compiler import SQLCompiler
+from sqlalchemy.sql.elements import ClauseElement
+from sqlalchemy.sql.functions import FunctionElement
 
+T = TypeVar("T")
 
-async def is_object_unique(
+
+async def get_unique_values_owners(
     session: AsyncSession,
     model: type[DeclarativeBase],
-    data: BaseModel | Mapping[str, Any],
+    data: Sequence[BaseModel | Mapping[str, Any]],
     unique_fields: tuple[str, ...],
-    exclude_id: int | None = None,
-) -> bool:
-    if getattr(model, "id") is None:
-        raise ValueError(f"{model.__tablename__} does not have id field.")
-    data = data.model_dump(exclude_unset=True) if isinstance(data, BaseModel) else data
-
-    fields_to_check = [field for field in unique_fields if field in data]
-    if not fields_to_check:
-        return True  # Data has no unique fields
-
-    ex = exists().where(
-        or_(*[getattr(model, field) == data[field] for field in fields_to_check])
+) -> dict[str, dict[Any, int]]:
+    """Check a batch of objects in one query.
+
+    Return the unique values of the batch which are already present in the DB, mapped
+    to the ids of the objects owning them.
+    """
+    rows = [
+        item.model_dump(exclude_unset=True) if isinstance(item, BaseModel) else item
+        for item in data
+    ]
+    values = {
+        field: {row[field] for row in rows if row.get(field) is not None}
+        for field in unique_fields
+    }
+    owners: dict[str, dict[Any, int]] = {field: {} for field in unique_fields}
+    conditions = [
+        getattr(model, field).in_(field_values)
+        for field, field_values in values.items()
+        if field_values
+    ]
+    if not conditions:
+        return owners
+
+    columns = [getattr(model, field) for field in unique_fields]
+    statement = select(getattr(model, "id"), *columns).where(or_(*conditions))
+    for obj_id, *obj_values in (await session.execute(statement)).all():
+        for field, value in zip(unique_fields, obj_values):
+            if value in values[field]:
+                owners[field][value] = obj_id
+    return owners
+
+
+def chunked(items: Sequence[T], size: int) -> Iterator[Sequence[T]]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def prefix_upper_bound(prefix: str) -> str | None:
+    """Return the smallest string greater than all the strings starting with `prefix`
+    in the code point (and UTF-8 byte) order, None if there's no such string.
+    """
+    while prefix:
+        next_code_point = ord(prefix[-1]) + 1
+        if 0xD800 <= next_code_point <= 0xDFFF:
+            # Surrogates can't be encoded
+            next_code_point = 0xE000
+        if next_code_point <= 0x10FFFF:
+            return prefix[:-1] + chr(next_code_point)
+        prefix = prefix[:-1]
+    return None
+
+
+class starts_with(FunctionElement[Any]):
+    """Case-sensitive prefix match written as a range, which can be looked up in a
+    B-tree index of the column, unlike LIKE on SQLite or with the non-C collations of
+    PostgreSQL.
+
+    PostgreSQL compares the strings with the pattern operators (~>=~, ~<~), which are
+    served by `text_pattern_ops` indexes.
+    """
+
+    inherit_cache = True
+    name = "starts_with"
+
+    def __init__(self, column: Any, prefix: str) -> None:
+        upper_bound = prefix_upper_bound(prefix)
+        bounds = (prefix,) if upper_bound is None else (prefix, upper_bound)
+        super().__init__(column, *bounds)
+
+
+def _compile_starts_with(
+    element: starts_with, compiler: SQLCompiler, ge: str, lt: str, **kw: Any
+) -> str:
+    column, *bounds = (compiler.process(clause, **kw) for clause in element.clauses)
+    conditions = [
+        f"{column} {operator} {bound}" for operator, bound in zip((ge, lt), bounds)
+    ]
+    return f"({' AND '.join(conditions)})"
+
+
+@compiles(starts_with)
+def _compile_starts_with_default(
+    element: starts_with, compiler: SQLCompiler, **kw: Any
+) -> str:
+    return _compile_starts_with(element, compiler, ">=", "<", **kw)
+
+
+@compiles(starts_with, "postgresql")
+def _compile_starts_with_postgresql(
+    element: starts_with, compiler: SQLCompiler, **kw: Any
+) -> str:
+    return _compile_starts_with(element, compiler, "~>=~", "~<~", **kw)
+
+
+class explain(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) of a statement, PostgreSQL only."""
+
+    inherit_cache = False
+
+    def __init__(self, statement: Select[Any]) -> None:
+        self.statement = statement
+
+
+@compiles(explain, "postgresql")
+def _compile_explain(element: explain, compiler: SQLCompiler, **kw: Any) -> str:
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kw)}"
+
+
+async def estimate_rows(session: AsyncSession, statement: Select[Any]) -> int:
+    """Return the number of rows of the statement estimated by the PostgreSQL
+    planner, without running it.
+    """
+    plan = await session.scalar(explain(statement))
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+async def estimate_table_rows(
+    session: AsyncSession, model: type[DeclarativeBase]
+) -> int | None:
+    """Return the number of rows of the model's table in the PostgreSQL statistics,
+    updated by VACUUM and ANALYZE, None if the table hasn't been analyzed yet.
+    """
+    table = session.get_bind().dialect.identifier_preparer.format_table(
+        model.__table__  # type: ignore
     )
-    if exclude_id is not None:
-        ex = ex.where(getattr(model, "id") != exclude_id)
-    return not await session.scalar(select(ex))
+    statement = text(
+        "SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)"
+    ).bindparams(bindparam("table", table))
+    reltuples = await session.scalar(statement)
+    return None if reltuples is None or reltuples < 0 else round(reltuples)
+
+
+def get_unique_constraints(model: type[DeclarativeBase]) -> dict[str, tuple[str, ...]]:
+    """Map the names of the unique constraints and indexes of the model's table (see
+    the naming convention of `Base.metadata`) to their columns.
+    """
+    table = model.__table__
+    return {
+        str(item.name): tuple(column.name for column in item.columns)
+        for item in (*table.constraints, *table.indexes)  # type: ignore
+        if isinstance(item, UniqueConstraint)
+        or (isinstance(item, Index) and item.unique)
+    }
+
+
+def get_violated_unique_constraint(
+    error: IntegrityError, model: type[DeclarativeBase]
+) -> str | None:
+    """Return the name of the model's unique constraint violated by the statement."""
+    constraints = get_unique_constraints(model)
+    # asyncpg reports the name of the constraint
+    if error.orig is None:
+        return None
+    name = getattr(error.orig.__cause__, "constraint_name", None)
+    if name in constraints:
+        return name
+    # SQLite reports the columns only, e.g. "UNIQUE constraint failed: user.email"
+    message = str(error.orig)
+    prefix = "UNIQUE constraint failed: "
+    if message.startswith(prefix):
+        columns = tuple(
+            column.strip().rpartition(".")[2]
+            for column in message.removeprefix(prefix).split(",")
+        )
+        for name, constraint_columns in constraints.items():
+            if constraint_columns == columns:
+                return name
+    return None
+
+
+@contextlib.contextmanager
+def unique_violation_handler(
+    model: type[DeclarativeBase], detail: str, status_code: int = 400
+) -> Iterator[None]:
+    """Translate the violations of the model's unique constraints by the statements
+    executed inside the block into HTTPException.
+
+    This replaces checking uniqueness with a query before the write, which costs an
+    extra round trip and is racy under concurrent writes.
+    """
+    try:
+        yield
+    except IntegrityError as e:
+        if get_violated_unique_constraint(e, model) is None:
+            raise
+        raise HTTPException(status_code=status_code, detail=detail) from e
@@ -28,9 +28,14 @@
 
 
 import contextlib
-from typing import Any, AsyncIterator
+import itertools
+import logging
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, AsyncIterator, Sequence
 
-from sqlalchemy import MetaData
+import anyio
+from sqlalchemy import MetaData, event, make_url, text
 from sqlalchemy.ext.asyncio import (
     AsyncConnection,
     AsyncEngine,
@@ -38,9 +43,13 @@ from sqlalchemy.ext.asyncio import (
     async_sessionmaker,
     create_async_engine,
 )
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, ConnectionPoolEntry, Pool
 
 from app.config import settings
+from app.metrics import db_pool_checkout_wait_seconds
+
+logger = logging.getLogger(__name__)
 
 
 class Base(DeclarativeBase):
@@ -56,20 +65,267 @@ class Base(DeclarativeBase):
     )
 
 
+@dataclass(frozen=True)
+class PoolStats:
+    size: int | None
+    checked_out: int | None
+    overflow: int | None
+    checkouts: int
+    wait_time_total: float
+    wait_time_max: float
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool which measures how long the checkouts wait for a connection."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def _do_get(self) -> ConnectionPoolEntry:
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait_time = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            db_pool_checkout_wait_seconds.observe(wait_time)
+
+
+def get_pool_stats(pool: Pool) -> PoolStats:
+    if not isinstance(pool, AsyncAdaptedQueuePool):
+        return PoolStats(None, None, None, 0, 0.0, 0.0)
+    checkouts, wait_time_total, wait_time_max = 0, 0.0, 0.0
+    if isinstance(pool, InstrumentedQueuePool):
+        checkouts = pool.checkouts
+        wait_time_total = pool.wait_time_total
+        wait_time_max = pool.wait_time_max
+    return PoolStats(
+        size=pool.size(),
+        checked_out=pool.checkedout(),
+        overflow=max(pool.overflow(), 0),
+        checkouts=checkouts,
+        wait_time_total=wait_time_total,
+        wait_time_max=wait_time_max,
+    )
+
+
+def get_engine_kwargs(host: str) -> dict[str, Any]:
+    """Build the pool and driver arguments for the engine from the settings."""
+    url = make_url(host)
+    if url.get_backend_name() == "sqlite":
+        return {}
+    engine_kwargs: dict[str, Any] = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+    if url.get_driver_name() == "asyncpg":
+        engine_kwargs["connect_args"] = {
+            "prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE
+        }
+    return engine_kwargs
+
+
+class RoutingSession(Session):
+    """Session which reads from the replica engine given in `info`, if any.
+
+    Flushes always go to the primary, and so do all statements once the primary
+    session of the same request has committed, so that the request reads its own
+    writes.
+    """
+
+    def get_bind(self, mapper: Any = None, clause: Any = None, **kwargs: Any) -> Any:
+        replica: AsyncEngine | None = self.info.get("replica")
+        primary: AsyncSession | LazySession | None = self.info.get("primary")
+        if (
+            replica is None
+            or self._flushing
+            or (primary is not None and primary.info.get("committed"))
+        ):
+            return super().get_bind(mapper, clause=clause, **kwargs)
+        return replica.sync_engine
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _mark_committed(session: Session) -> None:
+    session.info["committed"] = True
+
+
+if TYPE_CHECKING:
+    _AsyncSessionProxy = AsyncSession
+else:
+    _AsyncSessionProxy = object
+
+
+class LazySession(_AsyncSessionProxy):
+    """Proxy of AsyncSession which creates the session on first use. Type checkers
+    treat it as an AsyncSession, the attributes which aren't overridden are forwarded
+    to the session.
+
+    Requests which are rejected before any query (e.g. by the auth dependencies) never
+    create a session or check out a connection. With `release_after_read` the session
+    is closed right after every query, so the connection goes back to the pool as soon
+    as the query finishes instead of at the end of the request. The next query starts
+    a new session, so it's meant for the read-only sessions. The loaded objects stay
+    usable as the results are buffered and the attributes are never expired.
+    """
+
+    def __init__(
+        self,
+        sessionmaker: async_sessionmaker[AsyncSession],
+        release_after_read: bool = False,
+        info: dict[str, Any] | None = None,
+    ) -> None:
+        self._sessionmaker = sessionmaker
+        self._session: AsyncSession | None = None
+        self.release_after_read = release_after_read
+        # Shared by all the sessions created by the proxy
+        self.info: dict[str, Any] = dict(info or {})
+
+    @property
+    def session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._sessionmaker()
+            self._session.sync_session.info = self.info
+        return self._session
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.session, name)
+
+    async def _release(self) -> None:
+        if self.release_after_read and not (
+            self.session.new or self.session.dirty or self.session.deleted
+        ):
+            await self.close()
+
+    async def execute(self, *args: Any, **kwargs: Any) -> Any:
+        result = await self.session.execute(*args, **kwargs)
+        await self._release()
+        return result
+
+    async def scalar(self, *args: Any, **kwargs: Any) -> Any:
+        result = await self.session.scalar(*args, **kwargs)
+        await self._release()
+        return result
+
+    async def scalars(self, *args: Any, **kwargs: Any) -> Any:
+        result = await self.session.scalars(*args, **kwargs)
+        await self._release()
+        return result
+
+    async def get(self, *args: Any, **kwargs: Any) -> Any:
+        result = await self.session.get(*args, **kwargs)
+        await self._release()
+        return result
+
+    async def rollback(self) -> None:
+        if self._session is not None:
+            await self._session.rollback()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()
+
+    async def __aenter__(self) -> "LazySession":
+        return self
+
+    async def __aexit__(self, exc_type: Any, *args: Any) -> None:
+        try:
+            if exc_type is not None:
+                await self.rollback()
+        finally:
+            await self.close()
+
+
 class DatabaseSessionManager:
-    def __init__(self, host: str, engine_kwargs: dict[str, Any] = {}) -> None:
+    def __init__(
+        self,
+        host: str,
+        engine_kwargs: dict[str, Any] = {},
+        replica_hosts: Sequence[str] = (),
+    ) -> None:
         self._engine: AsyncEngine | None = create_async_engine(host, **engine_kwargs)
         self._sessionmaker: async_sessionmaker[AsyncSession] | None = (
-            async_sessionmaker(autocommit=False, bind=self._engine)
+            async_sessionmaker(
+                autocommit=False,
+                expire_on_commit=False,
+                bind=self._engine,
+                sync_session_class=RoutingSession,
+            )
         )
+        self._replicas = [
+            create_async_engine(replica_host, **engine_kwargs)
+            for replica_host in replica_hosts
+        ]
+        self._replicas_healthy = [True] * len(self._replicas)
+        self._replica_counter = itertools.count()
 
     async def close(self) -> None:
         if self._engine is None:
             raise RuntimeError("DatabaseSessionManager is not initialized.")
         await self._engine.dispose()
+        for replica in self._replicas:
+            await replica.dispose()
 
         self._engine = None
         self._sessionmaker = None
+        self._replicas = []
+        self._replicas_healthy = []
+
+    def pool_stats(self) -> dict[str, PoolStats]:
+        if self._engine is None:
+            raise RuntimeError("DatabaseSessionManager is not initialized.")
+        stats = {"primary": get_pool_stats(self._engine.pool)}
+        for index, replica in enumerate(self._replicas):
+            stats[f"replica_{index}"] = get_pool_stats(replica.pool)
+        return stats
+
+    def get_replica(self) -> AsyncEngine | None:
+        """Return the next healthy replica in round-robin order, if there is any."""
+        healthy = [
+            replica
+            for replica, is_healthy in zip(self._replicas, self._replicas_healthy)
+            if is_healthy
+        ]
+        if not healthy:
+            return None
+        return healthy[next(self._replica_counter) % len(healthy)]
+
+    async def check_replicas(self, timeout: float = 5) -> None:
+        for index, replica in enumerate(self._replicas):
+            error: Exception | None = None
+            try:
+                with anyio.fail_after(timeout):
+                    async with replica.connect() as connection:
+                        await connection.execute(text("SELECT 1"))
+            # Not only DBAPIError, the drivers raise some of their connection errors
+            # as is (e.g. asyncpg's CannotConnectNowError while a replica restarts)
+            except Exception as e:
+                error = e
+                logger.debug("Replica check failed.", exc_info=True)
+            is_healthy = error is None
+            if is_healthy != self._replicas_healthy[index]:
+                logger.warning(
+                    "Replica %s is %s.",
+                    replica.url.render_as_string(),
+                    "healthy" if is_healthy else "unhealthy",
+                    exc_info=error,
+                )
+            self._replicas_healthy[index] = is_healthy
+
+    async def monitor_replicas(self, interval: float) -> None:
+        while self._replicas:
+            await self.check_replicas()
+            await anyio.sleep(interval)
 
     @contextlib.asynccontextmanager
     async def connection(self) -> AsyncIterator[AsyncConnection]:
@@ -95,10 +351,35 @@ class DatabaseSessionManager:
                 await session.rollback()
                 raise
 
+    def lazy_session(self) -> LazySession:
+        if self._sessionmaker is None:
+            raise RuntimeError("DatabaseSessionManager is not initialized.")
+        return LazySession(self._sessionmaker)
 
-sessionmanager = DatabaseSessionManager(settings.DATABASE_URL)
+    def read_session(
+        self, session: AsyncSession | LazySession, use_replica: bool = True
+    ) -> LazySession:
+        """Lazy session for the read-only queries of the request which the primary
+        `session` belongs to. It's bound to a healthy replica if there is any and
+        `use_replica` is set.
+        """
+        if self._sessionmaker is None:
+            raise RuntimeError("DatabaseSessionManager is not initialized.")
+        replica = self.get_replica() if use_replica else None
+        return LazySession(
+            self._sessionmaker,
+            release_after_read=True,
+            info={"replica": replica, "primary": session},
+        )
+
+
+sessionmanager = DatabaseSessionManager(
+    settings.DATABASE_URL,
+    get_engine_kwargs(settings.DATABASE_URL),
+    settings.DATABASE_REPLICA_URLS,
+)
 
 
-async def get_db_session() -> AsyncIterator[AsyncSession]:
-    async with sessionmanager.session() as session:
+async def get_db_session() -> AsyncIterator[LazySession]:
+    async with sessionmanager.lazy_session() as session:
         yield session
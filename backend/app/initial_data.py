@@ -4,30 +4,33 @@ import logging
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import settings
-from app.crud.user import get_user_by_email
+from app.crud.user import get_user_row_by_unique_field
 from app.database import get_db_session
 from app.models.user import UserDB
-from app.utils.auth import get_password_hash
+from app.utils.auth import password_hasher
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
 async def init_db(session: AsyncSession) -> None:
-    user = await get_user_by_email(session, settings.FIRST_SUPERUSER)
+    user = await get_user_row_by_unique_field(
+        session, "email", settings.FIRST_SUPERUSER, ("id",)
+    )
     if not user:
         superuser = UserDB(
             username=settings.FIRST_SUPERUSER,
             email=settings.FIRST_SUPERUSER,
             first_name="Admin",
             last_name="User",
-            hashed_password=get_password_hash(settings.FIRST_SUPERUSER_PASSWORD),
+            hashed_password=await password_hasher.get_password_hash(
+                settings.FIRST_SUPERUSER_PASSWORD
+            ),
             is_superuser=True,
             is_active=True,
         )
         session.add(superuser)
         await session.commit()
-        await session.refresh(superuser)
         logger.info("Superuser created.")
     else:
         logger.info("Superuser already exists.")
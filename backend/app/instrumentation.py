@@ -0,0 +1,158 @@
+import contextlib
+import logging
+import time
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+from sqlalchemy import Connection, Engine, event
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.metrics import http_request_duration_seconds, http_requests_in_flight
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class QueryStats:
+    count: int = 0
+    duration: float = 0
+    statements: Counter[str] = field(default_factory=Counter)
+    # The statements in the order of execution with their parameters, only kept if
+    # requested from `track_queries`
+    executed: list[tuple[str, Any]] | None = None
+
+    def repeated_statements(self, threshold: int) -> dict[str, int]:
+        """Statements executed at least `threshold` times, which usually means that
+        rows are loaded one by one in a loop (N+1 queries).
+        """
+        return {
+            statement: count
+            for statement, count in self.statements.items()
+            if count >= threshold
+        }
+
+
+# Stats of the enclosing `track_queries` blocks, the innermost last
+_query_stats: ContextVar[tuple[QueryStats, ...]] = ContextVar("query_stats", default=())
+
+
+@contextlib.contextmanager
+def track_queries(keep_executed: bool = False) -> Iterator[QueryStats]:
+    """Collect the statements executed by all engines in the current context, the
+    nested blocks (e.g. of the requests made inside) included.
+    """
+    stats = QueryStats(executed=[] if keep_executed else None)
+    token = _query_stats.set(_query_stats.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn: Connection, *args: Any) -> None:
+    if _query_stats.get():
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(
+    conn: Connection, cursor: Any, statement: str, parameters: Any, *args: Any
+) -> None:
+    all_stats = _query_stats.get()
+    if not all_stats or not conn.info.get("query_start_time"):
+        return
+    duration = time.perf_counter() - conn.info["query_start_time"].pop()
+    for stats in all_stats:
+        stats.count += 1
+        stats.duration += duration
+        stats.statements[statement] += 1
+        if stats.executed is not None:
+            stats.executed.append((statement, parameters))
+
+
+class QueryStatsMiddleware:
+    """Counts and times the DB queries of every request.
+
+    The totals known when the response starts are sent in the `Server-Timing` header,
+    the final ones (including streamed responses) are logged with the request.
+    """
+
+    def __init__(self, app: ASGIApp, n_plus_one_threshold: int) -> None:
+        self.app = app
+        self.n_plus_one_threshold = n_plus_one_threshold
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_server_timing(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append(
+                    "Server-Timing",
+                    f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries"',
+                )
+            await send(message)
+
+        with track_queries() as stats:
+            try:
+                await self.app(scope, receive, send_with_server_timing)
+            finally:
+                self.log(scope, stats)
+
+    def log(self, scope: Scope, stats: QueryStats) -> None:
+        extra = {
+            "method": scope["method"],
+            "path": scope["path"],
+            "db_queries": stats.count,
+            "db_time_ms": round(stats.duration * 1000, 2),
+        }
+        logger.info("Request DB usage.", extra=extra)
+        repeated = stats.repeated_statements(self.n_plus_one_threshold)
+        if repeated:
+            logger.warning(
+                "Possible N+1 queries.", extra=extra | {"repeated_statements": repeated}
+            )
+
+
+class MetricsMiddleware:
+    """Records the latency of the requests by route template and the number of the
+    requests in flight.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_requests_in_flight.dec()
+            # The router stores the matched route in the scope, unmatched paths are
+            # grouped together to keep the number of the label values bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_request_duration_seconds.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=route,
+                status=str(status_code),
+            )
@@ -1,6 +1,94 @@
+import atexit
+import copy
+import datetime as dt
+import json
+import logging
+import logging.config
+import queue
 import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any
 
 from app.config import settings
+from app.metrics import log_records_dropped
+
+# Attributes of every LogRecord, the other ones are passed with `extra`
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {
+    "message",
+    "asctime",
+    "color_message",
+}
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats the records as JSON objects with the `extra` fields included."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: dict[str, Any] = {
+            "time": dt.datetime.fromtimestamp(record.created, dt.UTC).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(data, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler which drops the records when the queue is full instead of
+    blocking, so a slow log sink can't hold up the event loop.
+
+    Unlike `QueueHandler` it doesn't format the records, it's done by the handlers of
+    the listener in its thread, so the logged arguments must not be mutated later.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return copy.copy(record)
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+
+def setup_logging(config: dict[str, Any]) -> list[QueueListener]:
+    """Apply `config` and move the writes of every handler in it to a background
+    thread: the loggers get queue handlers, while the configured handlers are driven
+    by queue listeners.
+    """
+    logging.config.dictConfig(config)
+    loggers = [logging.getLogger(name) for name in config.get("loggers", {})]
+    if "root" in config:
+        loggers.append(logging.getLogger())
+    queue_handlers: dict[logging.Handler, QueueHandler] = {}
+    listeners = []
+    for logger in loggers:
+        for handler in list(logger.handlers):
+            if isinstance(handler, QueueHandler):
+                continue
+            if handler not in queue_handlers:
+                records: queue.Queue[logging.LogRecord] = queue.Queue(
+                    settings.LOG_QUEUE_SIZE
+                )
+                queue_handlers[handler] = DroppingQueueHandler(records)
+                listeners.append(
+                    QueueListener(records, handler, respect_handler_level=True)
+                )
+            logger.removeHandler(handler)
+            logger.addHandler(queue_handlers[handler])
+    for listener in listeners:
+        listener.start()
+        # Flushes the queued records at exit
+        atexit.register(listener.stop)
+    return listeners
+
 
 LOGGING_CONFIG = {
     "version": 1,
@@ -15,15 +103,18 @@ LOGGING_CONFIG = {
             " %(status_code)s",
             "use_colors": True,
         },
+        "json": {
+            "()": "app.logging_config.JSONFormatter",
+        },
     },
     "handlers": {
         "console": {
             "class": "logging.StreamHandler",
             "stream": sys.stdout,
-            "formatter": "default",
+            "formatter": "json" if settings.LOG_FORMAT == "json" else "default",
         },
         "access": {
-            "formatter": "access",
+            "formatter": "json" if settings.LOG_FORMAT == "json" else "access",
             "class": "logging.StreamHandler",
             "stream": sys.stdout,
         },
@@ -34,7 +125,7 @@ LOGGING_CONFIG = {
     },
     "loggers": {
         "sqlalchemy.engine": {
-            "level": "INFO",
+            "level": "INFO" if settings.DB_ECHO else "WARNING",
             "handlers": ["console"],
             "propagate": False,
         },
@@ -1,16 +1,25 @@
-import logging
-import logging.config
 from contextlib import asynccontextmanager
 
+import anyio
 import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 
 from app.api.main import api_router
 from app.config import settings
 from app.database import sessionmanager
-from app.logging_config import LOGGING_CONFIG
+from app.instrumentation import MetricsMiddleware, QueryStatsMiddleware
+from app.logging_config import LOGGING_CONFIG, setup_logging
+from app.metrics import (
+    db_pool_connections,
+    password_hashing_in_flight,
+    password_hashing_max_queue_depth,
+    password_hashing_queue_depth,
+    registry,
+)
+from app.utils.auth import password_hasher
 
-logging.config.dictConfig(LOGGING_CONFIG)
+setup_logging(LOGGING_CONFIG)
 
 
 @asynccontextmanager
@@ -19,7 +28,13 @@ async def lifespan(app: FastAPI):
     Function that handles startup and shutdown events.
     To understand more, read https://fastapi.tiangolo.com/advanced/events/
     """
-    yield
+    await password_hasher.prepare_dummy_hash()
+    async with anyio.create_task_group() as task_group:
+        task_group.start_soon(
+            sessionmanager.monitor_replicas, settings.DB_REPLICA_HEALTH_CHECK_INTERVAL
+        )
+        yield
+        task_group.cancel_scope.cancel()
     if sessionmanager._engine is not None:  # pyright: ignore
         # Close the DB connection
         await sessionmanager.close()
@@ -31,7 +46,30 @@ app = FastAPI(
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
 )
 
+app.add_middleware(
+    QueryStatsMiddleware, n_plus_one_threshold=settings.DB_N_PLUS_ONE_THRESHOLD
+)
+
+app.add_middleware(MetricsMiddleware)
+
 app.include_router(api_router, prefix=settings.API_V1_STR)
 
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> PlainTextResponse:
+    for pool, stats in sessionmanager.pool_stats().items():
+        for state in ("size", "checked_out", "overflow"):
+            value = getattr(stats, state)
+            if value is not None:
+                db_pool_connections.set(value, pool=pool, state=state)
+    hasher_stats = password_hasher.stats()
+    password_hashing_in_flight.set(hasher_stats.in_flight)
+    password_hashing_queue_depth.set(hasher_stats.queue_depth)
+    password_hashing_max_queue_depth.set(hasher_stats.max_queue_depth)
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", reload=True, port=8000)
@@ -0,0 +1,270 @@
+"""Metrics in the Prometheus text format.
+
+Most metrics are updated on the event loop thread only, so plain dicts are enough and
+their updates don't take any locks. Metrics updated from other threads must be
+`LockedCounter`s. Label values must have a small set of values (e.g. route
+templates rather than paths), every combination is kept in memory.
+"""
+
+import bisect
+import functools
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Iterator, ParamSpec, TypeVar
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.075,
+    0.1,
+    0.25,
+    0.5,
+    0.75,
+    1.0,
+    2.5,
+    5.0,
+    7.5,
+    10.0,
+)
+
+Sample = tuple[str, dict[str, str], float]
+
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple[str, ...] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        registry.register(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if labels.keys() != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}.")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _labels(self, key: tuple[str, ...]) -> dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    @abstractmethod
+    def samples(self) -> Iterator[Sample]: ...
+
+    @abstractmethod
+    def clear(self) -> None: ...
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple[str, ...] = ()
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[Sample]:
+        for key, value in self._values.items():
+            yield f"{self.name}_total", self._labels(key), value
+
+    def clear(self) -> None:
+        self._values.clear()
+
+
+class LockedCounter(Counter):
+    """Counter which can be incremented from any thread."""
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple[str, ...] = ()
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        with self._lock:
+            super().inc(amount, **labels)
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+    def samples(self) -> Iterator[Sample]:
+        for key, value in self._values.items():
+            yield self.name, self._labels(key), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Non-cumulative bucket counts, the last one is +Inf, and the sum
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = self._values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def count(self, **labels: str) -> int:
+        key = self._key(labels)
+        return sum(self._values[key][0]) if key in self._values else 0
+
+    def samples(self) -> Iterator[Sample]:
+        for key, (counts, total) in self._values.items():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                yield f"{self.name}_bucket", labels | {"le": le}, cumulative
+            yield f"{self.name}_sum", labels, total[0]
+            yield f"{self.name}_count", labels, cumulative
+
+    def clear(self) -> None:
+        self._values.clear()
+
+    def time(
+        self, **labels: str
+    ) -> Callable[[Callable[P, Awaitable[T]]], Callable[P, Awaitable[T]]]:
+        """Decorator observing the duration of the calls of a coroutine function."""
+
+        def decorator(func: Callable[P, Awaitable[T]]) -> Callable[P, Awaitable[T]]:
+            @functools.wraps(func)
+            async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+
+            return wrapper
+
+        return decorator
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered.")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_str = ",".join(
+                        f'{label}="{_escape(label_value)}"'
+                        for label, label_value in labels.items()
+                    )
+                    name = f"{name}{{{label_str}}}"
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self) -> None:
+        for metric in self._metrics.values():
+            metric.clear()
+
+
+registry = Registry()
+
+http_requests_in_flight = Gauge(
+    "http_requests_in_flight", "HTTP requests being processed."
+)
+http_request_duration_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Latency of the HTTP requests by route template.",
+    ("method", "route", "status"),
+)
+password_hashing_duration_seconds = Histogram(
+    "password_hashing_duration_seconds",
+    "Time spent hashing and verifying passwords, including the queue wait.",
+    ("operation",),
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0),
+)
+password_hashing_in_flight = Gauge(
+    "password_hashing_in_flight", "Password hashes being computed by the workers."
+)
+password_hashing_queue_depth = Gauge(
+    "password_hashing_queue_depth", "Password hashes waiting for a free worker."
+)
+password_hashing_max_queue_depth = Gauge(
+    "password_hashing_max_queue_depth",
+    "Largest number of the password hashes waiting for a free worker.",
+)
+dummy_password_verifications = Counter(
+    "dummy_password_verifications",
+    "Password verifications against a dummy hash for logins of unknown users.",
+)
+db_pool_checkout_wait_seconds = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time waited for a connection from the DB pool.",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+db_pool_connections = Gauge(
+    "db_pool_connections",
+    "Connections of the DB pools by state.",
+    ("pool", "state"),
+)
+# Incremented by the threads which log
+log_records_dropped = LockedCounter(
+    "log_records_dropped", "Log records dropped because the log queue was full."
+)
+rate_limited_requests = Counter(
+    "rate_limited_requests", "Requests rejected by the rate limiters.", ("limiter",)
+)
+crud_duration_seconds = Histogram(
+    "crud_duration_seconds", "Latency of the CRUD functions.", ("function",)
+)
+
+
+def timed_crud(func: Callable[P, Awaitable[T]]) -> Callable[P, Awaitable[T]]:
+    return crud_duration_seconds.time(function=func.__name__)(func)
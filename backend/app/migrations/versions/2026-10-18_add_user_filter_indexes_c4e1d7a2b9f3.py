@@ -0,0 +1,48 @@
+"""Add user filter indexes
+
+Revision ID: c4e1d7a2b9f3
+Revises: 5b2f0c1e9a7d
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c4e1d7a2b9f3"
+down_revision = "5b2f0c1e9a7d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_user_is_active_id", "user", ["is_active", "id"])
+    op.create_index(
+        "ix_user_superuser_id",
+        "user",
+        ["id"],
+        sqlite_where=sa.text("is_superuser = 1"),
+        postgresql_where=sa.text("is_superuser"),
+    )
+    if op.get_bind().dialect.name == "postgresql":
+        op.create_index(
+            "ix_user_username_pattern",
+            "user",
+            ["username"],
+            postgresql_ops={"username": "text_pattern_ops"},
+        )
+        op.create_index(
+            "ix_user_email_pattern",
+            "user",
+            ["email"],
+            postgresql_ops={"email": "text_pattern_ops"},
+        )
+
+
+def downgrade():
+    if op.get_bind().dialect.name == "postgresql":
+        op.drop_index("ix_user_email_pattern", table_name="user")
+        op.drop_index("ix_user_username_pattern", table_name="user")
+    op.drop_index("ix_user_superuser_id", table_name="user")
+    op.drop_index("ix_user_is_active_id", table_name="user")
@@ -0,0 +1,27 @@
+"""Add user token version
+
+Revision ID: 5b2f0c1e9a7d
+Revises: 8907a88f2c25
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5b2f0c1e9a7d"
+down_revision = "8907a88f2c25"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "user",
+        sa.Column("token_version", sa.Integer(), server_default="0", nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_column("user", "token_version")
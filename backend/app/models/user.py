@@ -1,5 +1,6 @@
 from typing import Optional
 
+from sqlalchemy import Index, text
 from sqlalchemy.orm import Mapped, mapped_column
 
 from . import Base
@@ -7,6 +8,32 @@ from . import Base
 
 class UserDB(Base):
     __tablename__ = "user"
+    # Fetch server defaults with INSERT ... RETURNING instead of a separate SELECT
+    __mapper_args__ = {"eager_defaults": True}
+    # Indexes of the filters of the users list, which is ordered by id
+    __table_args__ = (
+        Index("ix_user_is_active_id", "is_active", "id"),
+        # Superusers are few, the index covers only them. The predicate is written as
+        # rendered by the queries, SQLite needs an exact match to use the index.
+        Index(
+            "ix_user_superuser_id",
+            "id",
+            sqlite_where=text("is_superuser = 1"),
+            postgresql_where=text("is_superuser"),
+        ),
+        # Prefix search, the default indexes can't be used for it with the non-C
+        # collations. SQLite compares the strings bytewise, so the unique indexes do.
+        Index(
+            "ix_user_username_pattern",
+            "username",
+            postgresql_ops={"username": "text_pattern_ops"},
+        ).ddl_if(dialect="postgresql"),
+        Index(
+            "ix_user_email_pattern",
+            "email",
+            postgresql_ops={"email": "text_pattern_ops"},
+        ).ddl_if(dialect="postgresql"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     username: Mapped[str] = mapped_column(index=True, unique=True)
@@ -16,3 +43,5 @@ class UserDB(Base):
     hashed_password: Mapped[str]
     is_superuser: Mapped[bool] = mapped_column(server_default="false")
     is_active: Mapped[bool] = mapped_column(server_default="true")
+    # Incremented to revoke the issued access tokens
+    token_version: Mapped[int] = mapped_column(server_default="0")
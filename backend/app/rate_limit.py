@@ -0,0 +1,83 @@
+import time
+from abc import ABC, abstractmethod
+
+from app.cache import TTLLRUCache
+from app.config import settings
+
+
+class RateLimitBackend(ABC):
+    """Storage of the token buckets used by `RateLimiter`.
+
+    The in-memory backend limits every worker process separately. A backend on top of
+    a shared store (e.g. Redis) applies the limits across all workers.
+    """
+
+    @abstractmethod
+    async def consume(self, key: str, capacity: int, period: float) -> float:
+        """Take a token from the bucket of `key`, which holds up to `capacity` tokens
+        and is refilled completely in `period` seconds.
+
+        Return 0 if there was a token, otherwise the seconds until there is one.
+        """
+
+    @abstractmethod
+    async def clear(self) -> None: ...
+
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    def __init__(self, maxsize: int) -> None:
+        # Buckets idle for a whole period are full again, so they can be dropped
+        self._buckets: TTLLRUCache[str, tuple[float, float]] = TTLLRUCache(maxsize)
+
+    async def consume(self, key: str, capacity: int, period: float) -> float:
+        now = time.monotonic()
+        rate = capacity / period
+        bucket = self._buckets.get(key)
+        tokens = float(capacity)
+        if bucket is not None:
+            tokens = min(tokens, bucket[0] + (now - bucket[1]) * rate)
+        if tokens < 1:
+            self._buckets.set(key, (tokens, now), ttl=period)
+            return (1 - tokens) / rate
+        self._buckets.set(key, (tokens - 1, now), ttl=period)
+        return 0
+
+    async def clear(self) -> None:
+        self._buckets.clear()
+
+
+class RateLimiter:
+    """Token bucket limiter allowing bursts of `capacity` hits per key and `capacity`
+    hits per `period` seconds on average. `backend` can be replaced to share the limits
+    between workers.
+    """
+
+    def __init__(
+        self, name: str, capacity: int, period: float, backend: RateLimitBackend
+    ) -> None:
+        self.name = name
+        self.capacity = capacity
+        self.period = period
+        self.backend = backend
+
+    async def hit(self, key: str) -> float:
+        """Count a hit of `key`, return the seconds to wait if it's over the limit."""
+        return await self.backend.consume(
+            f"{self.name}:{key}", self.capacity, self.period
+        )
+
+
+rate_limit_backend = InMemoryRateLimitBackend(settings.RATE_LIMIT_MAX_KEYS)
+
+login_username_limiter = RateLimiter(
+    "login_username",
+    settings.LOGIN_RATE_LIMIT_USERNAME_ATTEMPTS,
+    settings.LOGIN_RATE_LIMIT_PERIOD_SECONDS,
+    rate_limit_backend,
+)
+login_ip_limiter = RateLimiter(
+    "login_ip",
+    settings.LOGIN_RATE_LIMIT_IP_ATTEMPTS,
+    settings.LOGIN_RATE_LIMIT_PERIOD_SECONDS,
+    rate_limit_backend,
+)
@@ -1,10 +1,50 @@
+import time
+from typing import Literal
+
 from pydantic import BaseModel
 
+from app.schemas.user import UserSnapshot
+
 
 class Token(BaseModel):
     access_token: str
+    refresh_token: str | None = None
     token_type: str = "bearer"
 
 
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
+
+
 class TokenPayload(BaseModel):
     sub: int | None
+    exp: int | None = None
+    type: Literal["access", "refresh"] = "access"
+    # Id of the refresh tokens
+    jti: str | None = None
+    # Token version of the user, the token is revoked when it changes
+    ver: int | None = None
+    # Optional authorization claims, trusted until claims_exp (a UNIX timestamp)
+    is_superuser: bool | None = None
+    is_active: bool | None = None
+    claims_exp: int | None = None
+
+    def fresh_claims(self) -> UserSnapshot | None:
+        """Return the user described by the claims, None if they are missing or
+        expired.
+        """
+        if (
+            self.sub is None
+            or self.is_superuser is None
+            or self.is_active is None
+            or self.ver is None
+            or self.claims_exp is None
+            or self.claims_exp <= time.time()
+        ):
+            return None
+        return UserSnapshot(
+            id=self.sub,
+            is_active=self.is_active,
+            is_superuser=self.is_superuser,
+            token_version=self.ver,
+        )
@@ -0,0 +1,19 @@
+from typing import Generic, TypeVar
+
+from pydantic import BaseModel
+
+T = TypeVar("T")
+
+
+class BulkError(BaseModel):
+    index: int
+    detail: str
+
+
+class BulkResult(BaseModel, Generic[T]):
+    """Result of a batch operation, `errors` refer to the items by their index in the
+    request body.
+    """
+
+    succeeded: list[T]
+    errors: list[BulkError]
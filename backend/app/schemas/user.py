@@ -18,6 +18,25 @@ class UserPublic(UserBase):
     id: int
 
 
+class UserSnapshot(BaseModel):
+    """The part of the user which is cached for the authorization checks."""
+
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    is_active: bool
+    is_superuser: bool
+    token_version: int
+
+
+class UserFilter(BaseModel):
+    is_active: bool | None = None
+    is_superuser: bool | None = None
+    # Case-sensitive prefixes
+    username_prefix: str | None = None
+    email_prefix: str | None = None
+
+
 class UserCreate(UserBase):
     password: str
 
@@ -27,6 +46,10 @@ class UserUpdate(UserBase):
     pass
 
 
+class UserBulkUpdate(UserUpdate):
+    id: int
+
+
 class UserUpdateMe(BaseModel):
     first_name: str | None = None
     last_name: str | None = None
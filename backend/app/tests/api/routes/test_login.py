@@ -1,9 +1,30 @@
+from datetime import timedelta
+from types import SimpleNamespace
+
 import pytest
+from fastapi import HTTPException
 from httpx import AsyncClient
+from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.api.dependencies.auth import decode_token, token_cache
+from app.cache import user_cache
 from app.config import settings
+from app.crud import user as crud_user
 from app.initial_data import init_db
+from app.instrumentation import track_queries
+from app.metrics import dummy_password_verifications, rate_limited_requests
+from app.models.user import UserDB
+from app.rate_limit import InMemoryRateLimitBackend
+from app.schemas.auth import TokenPayload
+from app.schemas.user import UserCreate
+from app.tests.utils import (
+    get_superuser_token_headers,
+    random_email,
+    random_lower_string,
+    user_authentication_headers,
+)
+from app.utils.auth import create_refresh_token, needs_rehash, password_hasher
 
 
 @pytest.mark.anyio
@@ -28,3 +49,199 @@ async def test_get_access_token_incorrect_password(client: AsyncClient) -> None:
     }
     r = await client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
     assert r.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_access_token_claims_authorize_without_db(
+    client: AsyncClient, session: AsyncSession, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "ACCESS_TOKEN_CLAIMS_EXPIRE_SECONDS", 60)
+    superuser_token_headers = await get_superuser_token_headers(client, session)
+    with track_queries() as stats:
+        r = await client.delete(
+            f"{settings.API_V1_STR}/users/0", headers=superuser_token_headers
+        )
+    assert r.status_code == 404
+    assert stats.count == 1
+
+    # The user is loaded once the claims are stale, and the token is revoked if the
+    # token version has changed meanwhile
+    monkeypatch.setattr(TokenPayload, "fresh_claims", lambda self: None)
+    r = await client.delete(
+        f"{settings.API_V1_STR}/users/0", headers=superuser_token_headers
+    )
+    assert r.status_code == 404
+    await session.execute(
+        update(UserDB)
+        .where(UserDB.email == settings.FIRST_SUPERUSER)
+        .values(token_version=UserDB.token_version + 1)
+    )
+    await user_cache.clear()
+    r = await client.delete(
+        f"{settings.API_V1_STR}/users/0", headers=superuser_token_headers
+    )
+    assert r.status_code == 403
+    assert r.json() == {"detail": "Token has been revoked."}
+
+
+@pytest.mark.anyio
+async def test_update_password_revokes_tokens(
+    client: AsyncClient, session: AsyncSession
+) -> None:
+    email = random_email()
+    password = random_lower_string()
+    user_in = UserCreate(username=email, email=email, password=password)
+    await crud_user.create_user(session, user_in)
+    await session.commit()
+    headers = await user_authentication_headers(client, email, password)
+    data = {"current_password": password, "new_password": random_lower_string()}
+    r = await client.patch(
+        f"{settings.API_V1_STR}/users/me/password", headers=headers, json=data
+    )
+    assert r.status_code == 200
+    # The route loads the whole user, so the token version is checked right away
+    r = await client.patch(
+        f"{settings.API_V1_STR}/users/me/password", headers=headers, json=data
+    )
+    assert r.status_code == 403
+    assert r.json() == {"detail": "Token has been revoked."}
+
+
+@pytest.mark.anyio
+async def test_refresh_token_rotation(
+    client: AsyncClient, session: AsyncSession
+) -> None:
+    await init_db(session)
+    login_data = {
+        "username": settings.FIRST_SUPERUSER,
+        "password": settings.FIRST_SUPERUSER_PASSWORD,
+    }
+    r = await client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    refresh_token = r.json()["refresh_token"]
+    assert refresh_token
+    # Refresh tokens are not accepted in place of access tokens
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/",
+        headers={"Authorization": f"Bearer {refresh_token}"},
+    )
+    assert r.status_code == 403
+
+    r = await client.post(
+        f"{settings.API_V1_STR}/login/refresh-token",
+        json={"refresh_token": refresh_token},
+    )
+    assert r.status_code == 200
+    tokens = r.json()
+    assert tokens["refresh_token"] != refresh_token
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/",
+        headers={"Authorization": f"Bearer {tokens['access_token']}"},
+    )
+    assert r.status_code == 200
+
+    # Reuse of a rotated refresh token revokes the whole token family
+    r = await client.post(
+        f"{settings.API_V1_STR}/login/refresh-token",
+        json={"refresh_token": refresh_token},
+    )
+    assert r.status_code == 403
+    r = await client.post(
+        f"{settings.API_V1_STR}/login/refresh-token",
+        json={"refresh_token": tokens["refresh_token"]},
+    )
+    assert r.status_code == 403
+    assert r.json() == {"detail": "Token has been revoked."}
+
+
+@pytest.mark.anyio
+async def test_refresh_token_invalid(client: AsyncClient) -> None:
+    r = await client.post(
+        f"{settings.API_V1_STR}/login/refresh-token",
+        json={"refresh_token": "invalid"},
+    )
+    assert r.status_code == 403
+    assert r.json() == {"detail": "Could not validate credentials."}
+
+
+def test_decode_token_cache() -> None:
+    token = create_refresh_token(1, 0, timedelta(minutes=1))
+    assert decode_token(token, "refresh").sub == 1
+    assert len(token_cache) == 1
+    # The type is checked for the cached payloads as well
+    with pytest.raises(HTTPException):
+        decode_token(token)
+    with pytest.raises(HTTPException):
+        decode_token(token[:-1])
+    assert decode_token(token, "refresh").jti
+
+
+@pytest.mark.anyio
+async def test_login_rate_limit(client: AsyncClient) -> None:
+    login_data = {"username": settings.FIRST_SUPERUSER, "password": "incorrect"}
+    for _ in range(settings.LOGIN_RATE_LIMIT_USERNAME_ATTEMPTS):
+        r = await client.post(
+            f"{settings.API_V1_STR}/login/access-token", data=login_data
+        )
+        assert r.status_code == 400
+    throttled = rate_limited_requests.get(limiter="login_username")
+    with track_queries() as stats:
+        r = await client.post(
+            f"{settings.API_V1_STR}/login/access-token", data=login_data
+        )
+    assert r.status_code == 429
+    assert int(r.headers["retry-after"]) > 0
+    assert stats.count == 0
+    assert rate_limited_requests.get(limiter="login_username") == throttled + 1
+
+
+@pytest.mark.anyio
+async def test_in_memory_rate_limit_backend(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = 0.0
+    monkeypatch.setattr("app.rate_limit.time", SimpleNamespace(monotonic=lambda: now))
+    backend = InMemoryRateLimitBackend(maxsize=10)
+    assert await backend.consume("key", capacity=2, period=10) == 0
+    assert await backend.consume("key", capacity=2, period=10) == 0
+    assert await backend.consume("key", capacity=2, period=10) == 5
+    assert await backend.consume("another", capacity=2, period=10) == 0
+    now = 5.0
+    assert await backend.consume("key", capacity=2, period=10) == 0
+    assert await backend.consume("key", capacity=2, period=10) == 5
+
+
+@pytest.mark.anyio
+async def test_login_rehashes_outdated_password_hash(
+    client: AsyncClient, session: AsyncSession, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    email = random_email()
+    password = random_lower_string()
+    user_in = UserCreate(username=email, email=email, password=password)
+    user = await crud_user.create_user(session, user_in)
+    await session.commit()
+    user_id = user.id
+    assert not needs_rehash(user.hashed_password)
+
+    monkeypatch.setattr(settings, "BCRYPT_ROUNDS", 4)
+    login_data = {"username": email, "password": password}
+    r = await client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    assert r.status_code == 200
+    hashed_password = (
+        await session.execute(
+            select(UserDB.hashed_password).where(UserDB.id == user_id)
+        )
+    ).scalar_one()
+    assert hashed_password.startswith("$2b$04$")
+    assert not needs_rehash(hashed_password)
+    r = await client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    assert r.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_login_unknown_user_verifies_dummy_hash(client: AsyncClient) -> None:
+    verifications = dummy_password_verifications.get()
+    completed = password_hasher.stats().completed
+    login_data = {"username": random_email(), "password": "password"}
+    r = await client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    assert r.status_code == 400
+    assert r.json() == {"detail": "Incorrect username or password."}
+    assert dummy_password_verifications.get() == verifications + 1
+    assert password_hasher.stats().completed > completed
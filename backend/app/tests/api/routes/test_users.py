@@ -1,9 +1,34 @@
+import csv
+import io
+import json
+import re
+from typing import Any, Sequence
+
 import pytest
 from httpx import AsyncClient
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 
+from app.cache import user_cache
 from app.config import settings
-from app.tests.utils import create_random_user
+from app.crud import user as crud_user
+from app.instrumentation import track_queries
+from app.models.user import UserDB
+from app.schemas.bulk import BulkError
+from app.schemas.user import UserBulkUpdate, UserCreate, UserFilter, UserUpdate
+from app.tests.utils import create_random_user, random_lower_string
+from app.utils.auth import password_hasher
+
+
+@pytest.mark.anyio
+async def test_get_user_row_is_not_tracked(session: AsyncSession) -> None:
+    user = await create_random_user(session)
+    user_id = user.id
+    session.expunge_all()
+    row = await crud_user.get_user_row(session, user_id)
+    assert row._fields == crud_user.USER_PUBLIC_COLUMNS
+    assert row.id == user_id
+    assert len(session.identity_map) == 0
 
 
 @pytest.mark.anyio
@@ -58,6 +83,350 @@ async def test_get_users(
     assert len(users) + 1 == len(r.json())
 
 
+@pytest.mark.anyio
+async def test_get_users_cursor_pagination(
+    client: AsyncClient, superuser_token_headers: dict[str, str], session: AsyncSession
+) -> None:
+    users = [await create_random_user(session) for _ in range(5)]
+    user_ids: list[int] = []
+    params: dict[str, str | int] = {"limit": 2}
+    while True:
+        r = await client.get(
+            f"{settings.API_V1_STR}/users/",
+            headers=superuser_token_headers,
+            params=params,
+        )
+        assert r.status_code == 200
+        assert len(r.json()) <= 2
+        user_ids.extend(user["id"] for user in r.json())
+        if "X-Next-Cursor" not in r.headers:
+            break
+        params["cursor"] = r.headers["X-Next-Cursor"]
+    assert user_ids == sorted(user_ids)
+    assert {user.id for user in users} < set(user_ids)
+    assert len(user_ids) == len(users) + 1
+
+
+@pytest.mark.anyio
+async def test_get_users_invalid_cursor(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/",
+        headers=superuser_token_headers,
+        params={"cursor": "invalid"},
+    )
+    assert r.status_code == 400
+    assert r.json() == {"detail": "Invalid cursor."}
+
+
+@pytest.mark.anyio
+async def test_get_users_page_size_limit(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/",
+        headers=superuser_token_headers,
+        params={"limit": settings.MAX_PAGE_SIZE + 1},
+    )
+    assert r.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_get_users_fields(
+    client: AsyncClient,
+    superuser_token_headers: dict[str, str],
+    session: AsyncSession,
+) -> None:
+    users = [await create_random_user(session) for _ in range(3)]
+    with track_queries(keep_executed=True) as stats:
+        r = await client.get(
+            f"{settings.API_V1_STR}/users/",
+            headers=superuser_token_headers,
+            params={"fields": "username, email", "limit": 2},
+        )
+    assert r.status_code == 200
+    assert [list(user) for user in r.json()] == [["username", "email"]] * 2
+    # The id is selected for the cursor only
+    assert stats.executed
+    assert "first_name" not in stats.executed[-1][0]
+
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/",
+        headers=superuser_token_headers,
+        params={"fields": "id", "cursor": r.headers["X-Next-Cursor"]},
+    )
+    assert r.status_code == 200
+    assert r.json() == [{"id": user.id} for user in users[1:]]
+
+
+@pytest.mark.anyio
+async def test_get_user_fields(
+    client: AsyncClient, superuser_token_headers: dict[str, str], session: AsyncSession
+) -> None:
+    user = await create_random_user(session)
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/{user.id}",
+        headers=superuser_token_headers,
+        params={"fields": "is_active,id"},
+    )
+    assert r.status_code == 200
+    assert r.json() == {"id": user.id, "is_active": True}
+
+
+@pytest.mark.anyio
+async def test_get_users_invalid_fields(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/",
+        headers=superuser_token_headers,
+        params={"fields": "id,hashed_password"},
+    )
+    assert r.status_code == 400
+    assert r.json() == {"detail": "Unknown fields: hashed_password."}
+
+
+@pytest.mark.anyio
+async def test_get_users_filters(
+    client: AsyncClient, superuser_token_headers: dict[str, str], session: AsyncSession
+) -> None:
+    for username, flags in [
+        ("filtera", {"is_active": False}),
+        ("filterb", {"is_superuser": True}),
+        ("filterc", {}),
+        ("Filterd", {}),
+    ]:
+        user_in = UserCreate.model_validate(
+            {
+                "username": username,
+                "email": f"{username}@example.com",
+                "password": random_lower_string(),
+                **flags,
+            }
+        )
+        await crud_user.create_user(session, user_in)
+    await session.commit()
+
+    filters: list[tuple[dict[str, Any], list[str]]] = [
+        ({"username_prefix": "filter"}, ["filtera", "filterb", "filterc"]),
+        ({"username_prefix": "filtera"}, ["filtera"]),
+        ({"username_prefix": "filter", "is_active": False}, ["filtera"]),
+        ({"username_prefix": "filter", "is_superuser": True}, ["filterb"]),
+        ({"username_prefix": "filter", "is_superuser": False}, ["filtera", "filterc"]),
+        ({"email_prefix": "Filter"}, ["Filterd"]),
+    ]
+    for params, usernames in filters:
+        r = await client.get(
+            f"{settings.API_V1_STR}/users/",
+            headers=superuser_token_headers,
+            params={**params, "fields": "username"},
+        )
+        assert r.status_code == 200
+        assert [user["username"] for user in r.json()] == usernames
+
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/",
+        headers=superuser_token_headers,
+        params={"username_prefix": ""},
+    )
+    assert r.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_get_users_total_count(
+    client: AsyncClient, superuser_token_headers: dict[str, str], session: AsyncSession
+) -> None:
+    users = [await create_random_user(session) for _ in range(3)]
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/",
+        headers=superuser_token_headers,
+        params={"limit": 1, "total_count": True},
+    )
+    assert r.status_code == 200
+    assert len(r.json()) == 1
+    assert r.headers["X-Total-Count"] == str(len(users) + 1)
+    assert r.headers["X-Total-Count-Estimated"] == "false"
+
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/",
+        headers=superuser_token_headers,
+        params={"email_prefix": users[0].email, "total_count": True},
+    )
+    assert r.headers["X-Total-Count"] == "1"
+
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/", headers=superuser_token_headers
+    )
+    assert "X-Total-Count" not in r.headers
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "params, index",
+    [
+        ({"is_active": False}, "ix_user_is_active_id"),
+        ({"is_superuser": True}, "ix_user_superuser_id"),
+        ({"username_prefix": "user"}, "ix_user_username"),
+        ({"email_prefix": "user"}, "ix_user_email"),
+    ],
+)
+async def test_get_users_filters_use_indexes(
+    client: AsyncClient,
+    superuser_token_headers: dict[str, str],
+    engine: AsyncEngine,
+    params: dict[str, Any],
+    index: str,
+) -> None:
+    with track_queries(keep_executed=True) as stats:
+        r = await client.get(
+            f"{settings.API_V1_STR}/users/",
+            headers=superuser_token_headers,
+            params=params,
+        )
+    assert r.status_code == 200
+    assert stats.executed
+    statement, parameters = stats.executed[-1]
+    async with engine.connect() as conn:
+        result = await conn.exec_driver_sql(
+            f"EXPLAIN QUERY PLAN {statement}", parameters
+        )
+        plan = [row[-1] for row in result]
+    assert any(
+        re.search(rf"^(SEARCH|SCAN) user USING (COVERING )?INDEX {index}\b", step)
+        for step in plan
+    ), plan
+
+
+def find_index_names(plan: dict[str, Any]) -> set[str]:
+    """Return the names of the indexes scanned by a plan of EXPLAIN (FORMAT JSON)."""
+    names = {plan["Index Name"]} if "Index Name" in plan else set()
+    for subplan in plan.get("Plans", []):
+        names |= find_index_names(subplan)
+    return names
+
+
+async def insert_users(session: AsyncSession, number: int) -> None:
+    """Insert `number` users, 1% of them inactive and 1% superusers, then update
+    the planner's statistics.
+    """
+    await session.execute(
+        insert(UserDB),
+        [
+            {
+                "username": f"user{i:04}",
+                "email": f"user{i:04}@example.com",
+                "hashed_password": "",
+                "is_active": i % 100 != 0,
+                "is_superuser": i % 100 == 50,
+            }
+            for i in range(number)
+        ],
+    )
+    await session.execute(text('ANALYZE "user"'))
+
+
+# asyncpg doesn't run on trio
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+@pytest.mark.parametrize(
+    "user_filter, index",
+    [
+        (UserFilter(is_active=False), "ix_user_is_active_id"),
+        (UserFilter(is_superuser=True), "ix_user_superuser_id"),
+        (UserFilter(username_prefix="user000"), "ix_user_username_pattern"),
+        (UserFilter(email_prefix="user000"), "ix_user_email_pattern"),
+    ],
+)
+async def test_get_users_filters_use_indexes_postgresql(
+    postgresql_session: AsyncSession, user_filter: UserFilter, index: str
+) -> None:
+    session = postgresql_session
+    await insert_users(session, 1000)
+    with track_queries(keep_executed=True) as stats:
+        await crud_user.get_users_rows(
+            session, ("id", "username"), limit=101, user_filter=user_filter
+        )
+    assert stats.executed
+    statement, parameters = stats.executed[-1]
+    connection = await session.connection()
+    plan = (
+        await connection.exec_driver_sql(
+            f"EXPLAIN (FORMAT JSON) {statement}", parameters
+        )
+    ).scalar_one()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    assert index in find_index_names(plan[0]["Plan"]), plan
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_count_users_postgresql(
+    postgresql_session: AsyncSession, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    session = postgresql_session
+    monkeypatch.setattr(settings, "TOTAL_COUNT_EXACT_LIMIT", 100)
+    # The table hasn't been analyzed, so it's counted
+    assert await crud_user.count_users(session) == (0, False)
+
+    await insert_users(session, 1000)
+    # From pg_class.reltuples
+    assert await crud_user.count_users(session) == (1000, True)
+    # Counted up to the limit
+    assert await crud_user.count_users(session, UserFilter(is_superuser=True)) == (
+        10,
+        False,
+    )
+    # From the query plan
+    count, estimated = await crud_user.count_users(session, UserFilter(is_active=True))
+    assert estimated
+    assert count > 100
+
+
+@pytest.mark.anyio
+async def test_export_users_ndjson(
+    client: AsyncClient, superuser_token_headers: dict[str, str], session: AsyncSession
+) -> None:
+    users = [await create_random_user(session) for _ in range(3)]
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/export", headers=superuser_token_headers
+    )
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/x-ndjson"
+    exported = [json.loads(line) for line in r.text.splitlines()]
+    assert len(exported) == len(users) + 1
+    assert {user.email for user in users} < {user["email"] for user in exported}
+    assert all(list(user) == list(crud_user.USER_PUBLIC_COLUMNS) for user in exported)
+
+
+@pytest.mark.anyio
+async def test_export_users_csv(
+    client: AsyncClient, superuser_token_headers: dict[str, str], session: AsyncSession
+) -> None:
+    users = [await create_random_user(session) for _ in range(3)]
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/export",
+        headers=superuser_token_headers,
+        params={"format": "csv"},
+    )
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/csv")
+    exported = list(csv.DictReader(io.StringIO(r.text)))
+    assert len(exported) == len(users) + 1
+    assert {user.email for user in users} < {user["email"] for user in exported}
+
+
+@pytest.mark.anyio
+async def test_export_users_permissions_error(
+    client: AsyncClient, normal_user_token_headers: dict[str, str]
+) -> None:
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/export", headers=normal_user_token_headers
+    )
+    assert r.status_code == 403
+
+
 @pytest.mark.anyio
 async def test_create_user(
     client: AsyncClient, superuser_token_headers: dict[str, str], session: AsyncSession
@@ -136,3 +505,261 @@ async def test_update_user_me_duplicate_username(
     assert r.json() == {
         "detail": "The user with the given email or username already exists."
     }
+
+
+@pytest.mark.anyio
+async def test_update_user_invalidates_cached_user(
+    client: AsyncClient,
+    superuser_token_headers: dict[str, str],
+    normal_user_token_headers: dict[str, str],
+    session: AsyncSession,
+) -> None:
+    user = await crud_user.get_user_by_email(session, settings.EMAIL_TEST_USER)
+    assert user
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/{user.id}", headers=normal_user_token_headers
+    )
+    assert r.status_code == 200
+    r = await client.patch(
+        f"{settings.API_V1_STR}/users/{user.id}",
+        headers=superuser_token_headers,
+        json={"is_active": False},
+    )
+    assert r.status_code == 200
+    # The tokens have no claims by default, so deactivation revokes them at once
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/{user.id}", headers=normal_user_token_headers
+    )
+    assert r.status_code == 403
+    assert r.json() == {"detail": "Token has been revoked."}
+
+
+@pytest.mark.anyio
+async def test_user_cache_invalidated_after_commit(session: AsyncSession) -> None:
+    user = await create_random_user(session)
+    user_id = user.id
+    snapshot = await crud_user.get_user_snapshot(session, user_id)
+    await crud_user.update_user(
+        session, user_id, UserUpdate.model_validate({"is_active": False})
+    )
+    # Concurrent requests keep reading the committed user until the commit
+    assert await user_cache.get(user_id) == snapshot
+    await crud_user.commit(session)
+    assert await user_cache.get(user_id) is None
+
+    await crud_user.get_user_snapshot(session, user_id)
+    await crud_user.revoke_tokens(session, user_id)
+    await session.rollback()
+    await crud_user.commit(session)
+    assert await user_cache.get(user_id) is not None
+
+
+@pytest.mark.anyio
+async def test_user_cache_skips_rows_read_before_invalidation(
+    session: AsyncSession, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    user = await create_random_user(session)
+    user_id = user.id
+    get_user_row = crud_user.get_user_row
+
+    async def get_user_row_then_deactivate(*args: Any) -> Any:
+        row = await get_user_row(*args)
+        # Another request deactivates the user after the row is read
+        await crud_user.update_user(
+            session, user_id, UserUpdate.model_validate({"is_active": False})
+        )
+        await crud_user.commit(session)
+        return row
+
+    monkeypatch.setattr(crud_user, "get_user_row", get_user_row_then_deactivate)
+    snapshot = await crud_user.get_user_snapshot(session, user_id)
+    assert snapshot.is_active
+    assert await user_cache.get(user_id) is None
+    monkeypatch.undo()
+    snapshot = await crud_user.get_user_snapshot(session, user_id)
+    assert not snapshot.is_active
+    assert await user_cache.get(user_id) == snapshot
+
+
+@pytest.mark.anyio
+async def test_create_users_bulk(
+    client: AsyncClient, superuser_token_headers: dict[str, str], session: AsyncSession
+) -> None:
+    user = await create_random_user(session)
+    data = [
+        {"email": "bulk1@example.com", "username": "bulk1", "password": "password1"},
+        {"email": user.email, "username": "bulk2", "password": "password2"},
+        {"email": "bulk3@example.com", "username": "bulk1", "password": "password3"},
+        {"email": "bulk4@example.com", "username": "bulk4", "password": "password4"},
+    ]
+    r = await client.post(
+        f"{settings.API_V1_STR}/users/bulk", headers=superuser_token_headers, json=data
+    )
+    assert r.status_code == 200
+    result = r.json()
+    assert [user["username"] for user in result["succeeded"]] == ["bulk1", "bulk4"]
+    assert [error["index"] for error in result["errors"]] == [1, 2]
+    login_data = {"username": "bulk4", "password": "password4"}
+    r = await client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    assert r.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_update_users_bulk(
+    client: AsyncClient, superuser_token_headers: dict[str, str], session: AsyncSession
+) -> None:
+    users = []
+    for _ in range(3):
+        user = await create_random_user(session)
+        users.append((user.id, user.email))
+    data = [
+        {"id": users[0][0], "first_name": "First"},
+        {"id": users[1][0], "is_active": False, "username": "bulkupdated"},
+        {"id": users[2][0], "email": users[0][1]},
+        {"id": 999999, "first_name": "Missing"},
+    ]
+    r = await client.patch(
+        f"{settings.API_V1_STR}/users/bulk", headers=superuser_token_headers, json=data
+    )
+    assert r.status_code == 200
+    result = r.json()
+    assert [(user["id"], user["first_name"]) for user in result["succeeded"]] == [
+        (users[0][0], "First"),
+        (users[1][0], ""),
+    ]
+    assert result["succeeded"][1]["username"] == "bulkupdated"
+    assert result["succeeded"][1]["is_active"] is False
+    assert result["errors"] == [
+        {
+            "index": 2,
+            "detail": "The user with the given email or username already exists.",
+        },
+        {"index": 3, "detail": "User not found."},
+    ]
+
+
+@pytest.mark.anyio
+async def test_create_users_hashes_before_queries(
+    session: AsyncSession, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    queries_before_hashing = []
+    get_password_hashes = password_hasher.get_password_hashes
+
+    async def counting_get_password_hashes(passwords: Sequence[str]) -> list[str]:
+        queries_before_hashing.append(stats.count)
+        return await get_password_hashes(passwords)
+
+    monkeypatch.setattr(
+        password_hasher, "get_password_hashes", counting_get_password_hashes
+    )
+    user_in = UserCreate(
+        email="hashfirst@example.com", username="hashfirst", password="password"
+    )
+    with track_queries() as stats:
+        users, errors = await crud_user.create_users(session, [user_in])
+    assert [user.username for user in users] == ["hashfirst"]
+    assert queries_before_hashing == [0]
+
+
+@pytest.mark.anyio
+async def test_update_users_missing_user_values(session: AsyncSession) -> None:
+    user = await create_random_user(session)
+    users_in = [
+        UserBulkUpdate.model_validate({"id": 999999, "email": "bulknew@example.com"}),
+        UserBulkUpdate.model_validate({"id": user.id, "email": "bulknew@example.com"}),
+    ]
+    users, errors = await crud_user.update_users(session, users_in)
+    assert [user.email for user in users] == ["bulknew@example.com"]
+    assert errors == [BulkError(index=0, detail="User not found.")]
+
+
+@pytest.mark.anyio
+async def test_update_users_concurrent_revocation(
+    session: AsyncSession, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    user = await create_random_user(session)
+    user_id, token_version = user.id, user.token_version
+    get_unique_values_owners = crud_user.get_unique_values_owners
+
+    async def revoke_and_get_unique_values_owners(*args: Any) -> Any:
+        # Stands for a request revoking the tokens during the bulk update
+        await crud_user.revoke_tokens(session, user_id)
+        return await get_unique_values_owners(*args)
+
+    monkeypatch.setattr(
+        crud_user, "get_unique_values_owners", revoke_and_get_unique_values_owners
+    )
+    users, _ = await crud_user.update_users(
+        session, [UserBulkUpdate.model_validate({"id": user_id, "is_active": False})]
+    )
+    assert users[0].token_version == token_version + 2
+
+
+@pytest.mark.anyio
+async def test_delete_users_bulk(
+    client: AsyncClient, superuser_token_headers: dict[str, str], session: AsyncSession
+) -> None:
+    user_ids = [(await create_random_user(session)).id for _ in range(2)]
+    user_ids.insert(1, 999999)
+    r = await client.request(
+        "DELETE",
+        f"{settings.API_V1_STR}/users/bulk",
+        headers=superuser_token_headers,
+        json=user_ids,
+    )
+    assert r.status_code == 200
+    assert r.json() == {
+        "succeeded": sorted([user_ids[0], user_ids[2]]),
+        "errors": [{"index": 1, "detail": "User not found."}],
+    }
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/{user_ids[0]}", headers=superuser_token_headers
+    )
+    assert r.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_write_endpoints_statement_count(
+    client: AsyncClient,
+    superuser_token_headers: dict[str, str],
+    normal_user_token_headers: dict[str, str],
+    session: AsyncSession,
+) -> None:
+    user = await create_random_user(session)
+    # Warm up the cached users, so that only the writes themselves are counted
+    await client.patch(
+        f"{settings.API_V1_STR}/users/me", headers=normal_user_token_headers, json={}
+    )
+    await client.get(
+        f"{settings.API_V1_STR}/users/{user.id}", headers=superuser_token_headers
+    )
+
+    data = {"email": "counted@example.com", "username": "counted", "password": "pwd"}
+    with track_queries() as stats:
+        r = await client.post(
+            f"{settings.API_V1_STR}/users/", headers=superuser_token_headers, json=data
+        )
+    assert r.status_code == 200
+    # INSERT ... RETURNING, uniqueness is enforced by the DB constraints
+    assert stats.count == 1
+
+    with track_queries() as stats:
+        r = await client.patch(
+            f"{settings.API_V1_STR}/users/{user.id}",
+            headers=superuser_token_headers,
+            json={"first_name": "Counted"},
+        )
+    assert r.status_code == 200
+    assert r.json()["first_name"] == "Counted"
+    # UPDATE ... RETURNING
+    assert stats.count == 1
+
+    with track_queries() as stats:
+        r = await client.patch(
+            f"{settings.API_V1_STR}/users/me",
+            headers=normal_user_token_headers,
+            json={"username": "countedme"},
+        )
+    assert r.status_code == 200
+    assert r.json()["username"] == "countedme"
+    assert stats.count == 1
@@ -0,0 +1,29 @@
+import pytest
+from httpx import AsyncClient
+
+from app.config import settings
+
+
+@pytest.mark.anyio
+async def test_read_db_pool_stats(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    r = await client.get(
+        f"{settings.API_V1_STR}/utils/db-pool", headers=superuser_token_headers
+    )
+    assert r.status_code == 200
+    stats = r.json()
+    assert "primary" in stats
+    assert {"checked_out", "overflow", "checkouts", "wait_time_max"} <= set(
+        stats["primary"]
+    )
+
+
+@pytest.mark.anyio
+async def test_read_db_pool_stats_permissions_error(
+    client: AsyncClient, normal_user_token_headers: dict[str, str]
+) -> None:
+    r = await client.get(
+        f"{settings.API_V1_STR}/utils/db-pool", headers=normal_user_token_headers
+    )
+    assert r.status_code == 403
@@ -1,4 +1,5 @@
-from typing import AsyncIterable
+import contextlib
+from typing import AsyncIterable, AsyncIterator, Iterator
 
 import pytest
 from httpx import ASGITransport, AsyncClient
@@ -9,9 +10,17 @@ from sqlalchemy.ext.asyncio import (
     create_async_engine,
 )
 
+from app.api.dependencies.auth import token_cache
+from app.api.dependencies.db import (
+    get_db_primary_read_session,
+    get_db_read_session,
+    get_session_factory,
+)
+from app.cache import used_refresh_tokens, user_cache
 from app.config import settings
 from app.database import Base, get_db_session
 from app.main import app
+from app.rate_limit import rate_limit_backend
 from app.tests.utils import authentication_token_from_email, get_superuser_token_headers
 
 
@@ -48,6 +57,36 @@ async def engine() -> AsyncIterable[AsyncEngine]:
 #         await _engine.dispose()
 
 
+@pytest.fixture(scope="session")
+def postgresql_url() -> Iterator[str]:
+    """URL of a temporary PostgreSQL database for the tests of its query plans, which
+    are skipped if no PostgreSQL server can be started.
+    """
+    testing_postgresql = pytest.importorskip("testing.postgresql")
+    try:
+        postgresql = testing_postgresql.Postgresql()
+    except RuntimeError as error:
+        pytest.skip(f"PostgreSQL is not available: {error}")
+    with postgresql:
+        yield postgresql.url().replace("postgresql://", "postgresql+asyncpg://")
+
+
+@pytest.fixture(scope="function")
+async def postgresql_session(postgresql_url: str) -> AsyncIterable[AsyncSession]:
+    """Like `session`, the tables are created in the rolled back transaction too."""
+    from sqlalchemy.pool import NullPool
+
+    _engine = create_async_engine(postgresql_url, poolclass=NullPool)
+    connection = await _engine.connect()
+    transaction = await connection.begin()
+    await connection.run_sync(Base.metadata.create_all)
+    yield AsyncSession(bind=connection, expire_on_commit=False)
+    if transaction.is_active:
+        await transaction.rollback()
+    await connection.close()
+    await _engine.dispose()
+
+
 @pytest.fixture(scope="function")
 async def session(engine: AsyncEngine) -> AsyncIterable[AsyncSession]:
     """Create a new database session with a rollback at the end of the test.
@@ -56,18 +95,40 @@ async def session(engine: AsyncEngine) -> AsyncIterable[AsyncSession]:
     """
     connection: AsyncConnection = await engine.connect()
     transaction = await connection.begin()
-    session = AsyncSession(bind=connection)
+    session = AsyncSession(bind=connection, expire_on_commit=False)
     yield session
-    await transaction.rollback()
+    # The transaction is already rolled back if a statement of the test failed
+    if transaction.is_active:
+        await transaction.rollback()
     await connection.close()
 
 
+@pytest.fixture(scope="function", autouse=True)
+async def clear_caches() -> AsyncIterable[None]:
+    """User ids are reused between the tests because of the rollbacks, so the cached
+    users must not outlive a test.
+    """
+    yield
+    await user_cache.clear()
+    await used_refresh_tokens.clear()
+    token_cache.clear()
+    await rate_limit_backend.clear()
+
+
 @pytest.fixture(scope="function")
 async def client(session: AsyncSession) -> AsyncIterable[AsyncClient]:
     """Create a test client that uses the override_get_db fixture to return
     a session.
     """
     app.dependency_overrides[get_db_session] = lambda: session
+    app.dependency_overrides[get_db_read_session] = lambda: session
+    app.dependency_overrides[get_db_primary_read_session] = lambda: session
+
+    @contextlib.asynccontextmanager
+    async def session_factory() -> AsyncIterator[AsyncSession]:
+        yield session
+
+    app.dependency_overrides[get_session_factory] = lambda: session_factory
     async with AsyncClient(
         transport=ASGITransport(app=app), base_url="http://test"
     ) as test_client:
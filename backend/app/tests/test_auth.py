@@ -0,0 +1,91 @@
+import sys
+import threading
+import time
+
+import anyio
+import pytest
+
+from app.utils.auth import (
+    PasswordHasher,
+    PasswordVerification,
+    _get_argon2_hasher,
+    verify_password,
+)
+
+
+@pytest.mark.anyio
+async def test_password_hasher_limits_workers(monkeypatch: pytest.MonkeyPatch) -> None:
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+
+    def get_password_hash(password: str) -> str:
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+        return password
+
+    monkeypatch.setattr("app.utils.auth.get_password_hash", get_password_hash)
+    hasher = PasswordHasher(max_workers=2)
+    ticks = 0
+
+    async def tick() -> None:
+        nonlocal ticks
+        while True:
+            await anyio.sleep(0.005)
+            ticks += 1
+
+    async with anyio.create_task_group() as task_group:
+        task_group.start_soon(tick)
+        passwords = [str(i) for i in range(6)]
+        assert await hasher.get_password_hashes(passwords) == passwords
+        task_group.cancel_scope.cancel()
+
+    assert max_running == 2
+    # 3 rounds of 50 ms, the event loop keeps running in the meantime
+    assert ticks >= 10
+    stats = hasher.stats()
+    assert stats.completed == 6
+    assert stats.in_flight == stats.queue_depth == 0
+    assert stats.max_queue_depth >= 4
+
+
+@pytest.mark.anyio
+async def test_dummy_hash_computed_once(monkeypatch: pytest.MonkeyPatch) -> None:
+    hashed = []
+
+    def get_password_hash(password: str) -> str:
+        time.sleep(0.01)
+        hashed.append(password)
+        return "dummy"
+
+    monkeypatch.setattr("app.utils.auth.get_password_hash", get_password_hash)
+    monkeypatch.setattr(
+        "app.utils.auth.verify_password",
+        lambda plain_password, hashed_password: PasswordVerification(False, False),
+    )
+    hasher = PasswordHasher()
+    async with anyio.create_task_group() as task_group:
+        for _ in range(5):
+            task_group.start_soon(hasher.verify_dummy_password, "password")
+    assert len(hashed) == 1
+
+
+def test_verify_argon2_password_without_argon2(
+    monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+) -> None:
+    # None in sys.modules makes the import fail
+    monkeypatch.setitem(sys.modules, "argon2", None)
+    _get_argon2_hasher.cache_clear()
+    hashed_password = "$argon2id$v=19$m=65536,t=3,p=4$c2FsdHNhbHQ$aGFzaGhhc2hoYXNo"
+    try:
+        assert verify_password("password", hashed_password) == PasswordVerification(
+            False, False
+        )
+    finally:
+        _get_argon2_hasher.cache_clear()
+    assert "Can't verify an argon2 password hash." in caplog.messages
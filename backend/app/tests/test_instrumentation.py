@@ -0,0 +1,60 @@
+import logging
+
+import pytest
+from httpx import AsyncClient
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.instrumentation import track_queries
+from app.models.user import UserDB
+
+
+@pytest.mark.anyio
+async def test_track_queries(session: AsyncSession) -> None:
+    with track_queries() as stats:
+        for user_id in range(3):
+            await session.scalar(select(UserDB).where(UserDB.id == user_id))
+    assert stats.count == 3
+    assert stats.duration > 0
+    assert stats.repeated_statements(3) == {
+        next(iter(stats.statements)): 3,
+    }
+    assert stats.repeated_statements(4) == {}
+    await session.scalar(select(UserDB))
+    assert stats.count == 3
+    assert stats.executed is None
+
+
+@pytest.mark.anyio
+async def test_track_queries_nested(session: AsyncSession) -> None:
+    with track_queries(keep_executed=True) as outer:
+        await session.scalar(select(UserDB).where(UserDB.id == 1))
+        with track_queries() as inner:
+            await session.scalar(select(UserDB).where(UserDB.id == 2))
+    assert inner.count == 1
+    assert outer.count == 2
+    assert outer.executed is not None
+    assert [parameters for _, parameters in outer.executed] == [(1,), (2,)]
+
+
+@pytest.mark.anyio
+async def test_server_timing_header(
+    client: AsyncClient,
+    superuser_token_headers: dict[str, str],
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    with caplog.at_level(logging.INFO, logger="app.instrumentation"):
+        r = await client.get(
+            f"{settings.API_V1_STR}/users/", headers=superuser_token_headers
+        )
+    assert r.status_code == 200
+    server_timing = r.headers["server-timing"]
+    assert server_timing.startswith("db;dur=")
+    assert server_timing.endswith('queries"')
+    record = next(
+        record for record in caplog.records if record.msg == "Request DB usage."
+    )
+    # Set through `extra`
+    assert getattr(record, "path") == f"{settings.API_V1_STR}/users/"
+    assert getattr(record, "db_queries") >= 1
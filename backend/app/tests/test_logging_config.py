@@ -0,0 +1,97 @@
+import atexit
+import io
+import json
+import logging
+import queue
+from logging.handlers import QueueListener
+from typing import Iterator
+
+import pytest
+
+from app.logging_config import DroppingQueueHandler, JSONFormatter, setup_logging
+from app.metrics import log_records_dropped
+
+
+def test_json_formatter() -> None:
+    record = logging.makeLogRecord(
+        {"name": "test", "levelname": "INFO", "msg": "%s done", "args": ("Job",)}
+    )
+    record.db_queries = 2
+    data = json.loads(JSONFormatter().format(record))
+    assert data["logger"] == "test"
+    assert data["level"] == "INFO"
+    assert data["message"] == "Job done"
+    assert data["db_queries"] == 2
+    assert "msg" not in data
+
+
+def test_dropping_queue_handler() -> None:
+    records: queue.Queue[logging.LogRecord] = queue.Queue(1)
+    handler = DroppingQueueHandler(records)
+    dropped = log_records_dropped.get()
+    record = logging.makeLogRecord({"msg": "message"})
+    handler.handle(record)
+    handler.handle(record)
+    assert records.qsize() == 1
+    assert log_records_dropped.get() == dropped + 1
+
+
+@pytest.fixture
+def listeners() -> Iterator[list[QueueListener]]:
+    """Collect the listeners started by `setup_logging`, which are stopped after the
+    test and the loggers configured by it restored.
+    """
+    loggers = [logging.getLogger()] + [
+        logger
+        for logger in logging.root.manager.loggerDict.values()
+        if isinstance(logger, logging.Logger)
+    ]
+    states = [
+        (logger, logger.handlers[:], logger.level, logger.propagate, logger.disabled)
+        for logger in loggers
+    ]
+    started: list[QueueListener] = []
+    yield started
+    for listener in started:
+        listener.stop()
+        atexit.unregister(listener.stop)
+    for logger in logging.root.manager.loggerDict.values():
+        if isinstance(logger, logging.Logger) and logger not in loggers:
+            logger.handlers.clear()
+    for logger, handlers, level, propagate, disabled in states:
+        logger.handlers[:] = handlers
+        logger.setLevel(level)
+        logger.propagate = propagate
+        logger.disabled = disabled
+
+
+def test_setup_logging(listeners: list[QueueListener]) -> None:
+    stream = io.StringIO()
+    config = {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "formatters": {"json": {"()": "app.logging_config.JSONFormatter"}},
+        "handlers": {
+            "stream": {
+                "class": "logging.StreamHandler",
+                "stream": stream,
+                "formatter": "json",
+            },
+        },
+        "loggers": {
+            "test_setup_logging": {
+                "handlers": ["stream"],
+                "level": "INFO",
+                "propagate": False,
+            },
+        },
+    }
+    listeners.extend(setup_logging(config))
+    assert len(listeners) == 1
+    logger = logging.getLogger("test_setup_logging")
+    assert [type(handler) for handler in logger.handlers] == [DroppingQueueHandler]
+    logger.info("Logged.", extra={"path": "/"})
+    records = listeners[0].queue
+    assert isinstance(records, queue.Queue)
+    records.join()
+    assert json.loads(stream.getvalue())["path"] == "/"
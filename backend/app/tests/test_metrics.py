@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+from httpx import AsyncClient
+
+from app.config import settings
+from app.metrics import Counter, Histogram, LockedCounter, Metric, Registry
+
+
+def test_render(monkeypatch: pytest.MonkeyPatch) -> None:
+    registry = Registry()
+    monkeypatch.setattr("app.metrics.registry", registry)
+    counter = Counter("test_events", "Test events.", ("kind",))
+    histogram = Histogram("test_duration_seconds", "Test durations.", buckets=(1, 2))
+    counter.inc(kind='a"b')
+    counter.inc(2, kind='a"b')
+    histogram.observe(0.5)
+    histogram.observe(2)
+    histogram.observe(3)
+
+    assert registry.render().splitlines() == [
+        "# HELP test_events Test events.",
+        "# TYPE test_events counter",
+        'test_events_total{kind="a\\"b"} 3',
+        "# HELP test_duration_seconds Test durations.",
+        "# TYPE test_duration_seconds histogram",
+        'test_duration_seconds_bucket{le="1"} 1',
+        'test_duration_seconds_bucket{le="2"} 2',
+        'test_duration_seconds_bucket{le="+Inf"} 3',
+        "test_duration_seconds_sum 5.5",
+        "test_duration_seconds_count 3",
+    ]
+    with pytest.raises(ValueError):
+        counter.inc()
+
+
+def test_locked_counter(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr("app.metrics.registry", Registry())
+    counter = LockedCounter("test_events", "Test events.")
+
+    def increment() -> None:
+        for _ in range(10_000):
+            counter.inc()
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.get() == 40_000
+
+
+def test_metric_requires_samples() -> None:
+    class Incomplete(Metric):
+        def clear(self) -> None:
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete("test_incomplete", "Test metric.")  # type: ignore[abstract]
+
+
+@pytest.mark.anyio
+async def test_metrics_endpoint(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    r = await client.get(
+        f"{settings.API_V1_STR}/users/12345", headers=superuser_token_headers
+    )
+    assert r.status_code == 404
+    r = await client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain")
+    route = f"{settings.API_V1_STR}/users/{{user_id}}"
+    assert (
+        f'http_request_duration_seconds_count{{method="GET",route="{route}",'
+        'status="404"} ' in r.text
+    )
+    assert 'password_hashing_duration_seconds_count{operation="verify_password"}' in (
+        r.text
+    )
+    assert 'crud_duration_seconds_count{function="get_user_row"}' in r.text
+    assert "http_requests_in_flight 1" in r.text
+    assert "password_hashing_in_flight 0" in r.text
+    assert "password_hashing_queue_depth 0" in r.text
+    assert "password_hashing_max_queue_depth " in r.text
@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+from app.schemas.user import UserPublic
+from app.utils.serialization import FastJSONResponse, RowSerializer, parse_fields
+
+
+def test_row_serializer() -> None:
+    serializer = RowSerializer(UserPublic)
+    assert serializer.fields[-1] == "id"
+    row = ("user", "user@example.com", None, "Last", False, True, 1)
+    data = json.loads(FastJSONResponse(serializer.dump_json([row])).body)
+    user = UserPublic.model_validate(dict(zip(serializer.fields, row)))
+    assert data == [user.model_dump()]
+    assert FastJSONResponse({"id": 1}).body == b'{"id":1}'
+
+
+def test_row_serializer_fields() -> None:
+    fields = parse_fields(UserPublic, "id, username,id")
+    assert fields == ("username", "id")
+    serializer = RowSerializer(UserPublic, fields)
+    assert (
+        serializer.dump_json_row(("user", 1, "extra")) == b'{"username":"user","id":1}'
+    )
+    with pytest.raises(ValueError, match="Unknown fields: password."):
+        parse_fields(UserPublic, "id,password")
+    with pytest.raises(ValueError, match="No fields given."):
+        parse_fields(UserPublic, " ,")
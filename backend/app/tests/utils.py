@@ -54,7 +54,6 @@ async def create_random_user(session: AsyncSession) -> UserDB:
     )
     user = await crud_user.create_user(session=session, user_in=user_in)
     await session.commit()
-    await session.refresh(user)
     return user
 
 
@@ -74,7 +73,6 @@ async def authentication_token_from_email(
     )
     user = await crud_user.create_user(session=session, user_in=user_in_create)
     await session.commit()
-    await session.refresh(user)
     return await user_authentication_headers(
         client=client, email=email, password=password
     )
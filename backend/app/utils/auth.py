@@ -1,29 +1,228 @@
 import datetime as dt
-from typing import Any
+import functools
+import logging
+import secrets
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Literal, NamedTuple, Sequence, TypeVar
 
+import anyio
+import anyio.to_process
+import anyio.to_thread
 import bcrypt
 import jwt
 
 from app.config import settings
+from app.metrics import dummy_password_verifications, password_hashing_duration_seconds
 
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
 
 ACCESS_TOKEN_ALGORITHM = "HS256"
 
 
-def create_access_token(subject: str | Any, expiration_delta: dt.timedelta) -> str:
+def create_access_token(
+    subject: str | Any,
+    expiration_delta: dt.timedelta,
+    claims: dict[str, Any] | None = None,
+) -> str:
     expire = dt.datetime.now(dt.UTC).replace(tzinfo=None) + expiration_delta
-    to_encode = {"exp": expire, "sub": str(subject)}
+    to_encode = {"exp": expire, "sub": str(subject), **(claims or {})}
     encoded_jwt = jwt.encode(
         to_encode, settings.SECRET_KEY, algorithm=ACCESS_TOKEN_ALGORITHM
     )
     return encoded_jwt
 
 
-def get_password_hash(password: str) -> str:
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+def create_refresh_token(
+    subject: str | Any, token_version: int, expiration_delta: dt.timedelta
+) -> str:
+    """Create a single-use refresh token with a unique id (jti)."""
+    return create_access_token(
+        subject,
+        expiration_delta,
+        claims={
+            "type": "refresh",
+            "ver": token_version,
+            "jti": secrets.token_urlsafe(16),
+        },
+    )
+
+
+class PasswordVerification(NamedTuple):
+    valid: bool
+    # The hash doesn't match the configured algorithm or work factor
+    needs_rehash: bool
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(
-        plain_password.encode("utf-8"), hashed_password.encode("utf-8")
+@functools.cache
+def _get_argon2_hasher() -> Any:
+    try:
+        import argon2
+    except ImportError:
+        raise RuntimeError("argon2-cffi must be installed to use argon2 hashes.")
+    return argon2.PasswordHasher(
+        time_cost=settings.ARGON2_TIME_COST,
+        memory_cost=settings.ARGON2_MEMORY_COST,
+        parallelism=settings.ARGON2_PARALLELISM,
     )
+
+
+def get_password_hash(password: str) -> str:
+    if settings.PASSWORD_HASHING_ALGORITHM == "argon2":
+        return _get_argon2_hasher().hash(password)
+    salt = bcrypt.gensalt(rounds=settings.BCRYPT_ROUNDS)
+    return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    if settings.PASSWORD_HASHING_ALGORITHM == "argon2":
+        if not hashed_password.startswith("$argon2"):
+            return True
+        return _get_argon2_hasher().check_needs_rehash(hashed_password)
+    # bcrypt hashes look like $2b$<rounds>$<salt and hash>
+    return hashed_password.split("$")[2:3] != [f"{settings.BCRYPT_ROUNDS:02d}"]
+
+
+def _verify_argon2_password(plain_password: str, hashed_password: str) -> bool:
+    try:
+        hasher = _get_argon2_hasher()
+    except RuntimeError:
+        # The logins of the users with argon2 hashes fail instead of erroring
+        logger.exception("Can't verify an argon2 password hash.")
+        return False
+    import argon2.exceptions
+
+    try:
+        return hasher.verify(hashed_password, plain_password)
+    except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHashError):
+        return False
+
+
+def verify_password(plain_password: str, hashed_password: str) -> PasswordVerification:
+    if hashed_password.startswith("$argon2"):
+        valid = _verify_argon2_password(plain_password, hashed_password)
+    else:
+        valid = bcrypt.checkpw(
+            plain_password.encode("utf-8"), hashed_password.encode("utf-8")
+        )
+    return PasswordVerification(valid, valid and needs_rehash(hashed_password))
+
+
+@dataclass(frozen=True)
+class PasswordHasherStats:
+    executor: str
+    max_workers: int
+    in_flight: int
+    queue_depth: int
+    max_queue_depth: int
+    completed: int
+
+
+class PasswordHasher:
+    """Runs the blocking bcrypt functions above in a bounded worker pool.
+
+    At most `max_workers` hashes are computed at the same time, the rest wait in the
+    queue, so a burst of logins doesn't block the event loop or starve other requests.
+    """
+
+    def __init__(
+        self, executor: Literal["thread", "process"] = "thread", max_workers: int = 4
+    ) -> None:
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown password hashing executor: {executor}.")
+        self.executor = executor
+        self._limiter = anyio.CapacityLimiter(max_workers)
+        # Calls waiting for a worker or running
+        self._pending = 0
+        self._max_queue_depth = 0
+        self._completed = 0
+        self._dummy_hash: tuple[tuple[Any, ...], str] | None = None
+        self._dummy_hash_lock = anyio.Lock()
+
+    def _queue_depth(self) -> int:
+        return max(0, self._pending - int(self._limiter.total_tokens))
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        self._pending += 1
+        self._max_queue_depth = max(self._max_queue_depth, self._queue_depth())
+        start = time.perf_counter()
+        try:
+            if self.executor == "process":
+                result = await anyio.to_process.run_sync(
+                    func, *args, limiter=self._limiter
+                )
+            else:
+                result = await anyio.to_thread.run_sync(
+                    func, *args, limiter=self._limiter
+                )
+        finally:
+            self._pending -= 1
+        self._completed += 1
+        password_hashing_duration_seconds.observe(
+            time.perf_counter() - start, operation=func.__name__
+        )
+        return result
+
+    async def get_password_hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+
+    async def get_password_hashes(self, passwords: Sequence[str]) -> list[str]:
+        """Hash the passwords concurrently, as far as the worker limit allows."""
+        hashes = [""] * len(passwords)
+
+        async def hash_password(index: int, password: str) -> None:
+            hashes[index] = await self.get_password_hash(password)
+
+        async with anyio.create_task_group() as task_group:
+            for index, password in enumerate(passwords):
+                task_group.start_soon(hash_password, index, password)
+        return hashes
+
+    async def verify_password(
+        self, plain_password: str, hashed_password: str
+    ) -> PasswordVerification:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def prepare_dummy_hash(self) -> str:
+        """Return the hash of a random password made with the current settings,
+        computing it once. It's called at startup, so that the first logins of unknown
+        users don't pay for it.
+        """
+        key = (
+            settings.PASSWORD_HASHING_ALGORITHM,
+            settings.BCRYPT_ROUNDS,
+            settings.ARGON2_TIME_COST,
+            settings.ARGON2_MEMORY_COST,
+            settings.ARGON2_PARALLELISM,
+        )
+        # Concurrent callers wait for the same hash instead of computing their own
+        async with self._dummy_hash_lock:
+            if self._dummy_hash is None or self._dummy_hash[0] != key:
+                dummy_hash = await self.get_password_hash(secrets.token_urlsafe())
+                self._dummy_hash = (key, dummy_hash)
+            return self._dummy_hash[1]
+
+    async def verify_dummy_password(self, plain_password: str) -> None:
+        """Verify the password against the dummy hash, so that logins of unknown
+        users take as long as the others and don't reveal which users exist.
+        """
+        await self.verify_password(plain_password, await self.prepare_dummy_hash())
+        dummy_password_verifications.inc()
+
+    def stats(self) -> PasswordHasherStats:
+        limiter_stats = self._limiter.statistics()
+        return PasswordHasherStats(
+            executor=self.executor,
+            max_workers=int(limiter_stats.total_tokens),
+            in_flight=limiter_stats.borrowed_tokens,
+            queue_depth=self._queue_depth(),
+            max_queue_depth=self._max_queue_depth,
+            completed=self._completed,
+        )
+
+
+password_hasher = PasswordHasher(
+    settings.PASSWORD_HASHING_EXECUTOR, settings.PASSWORD_HASHING_MAX_WORKERS
+)
@@ -0,0 +1,40 @@
+import csv
+import io
+from typing import Any, AsyncIterable, AsyncIterator, Sequence
+
+from app.utils.serialization import RowSerializer
+
+EXPORT_BATCH_SIZE = 500
+
+
+async def iter_ndjson(
+    rows: AsyncIterable[Sequence[Any]], serializer: RowSerializer
+) -> AsyncIterator[str]:
+    """Serialize rows as newline delimited JSON, yielding one chunk per batch."""
+    lines = []
+    async for row in rows:
+        lines.append(serializer.dump_json_row(row).decode("utf-8"))
+        if len(lines) >= EXPORT_BATCH_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+async def iter_csv(
+    rows: AsyncIterable[Sequence[Any]], serializer: RowSerializer
+) -> AsyncIterator[str]:
+    """Serialize rows as CSV with a header row, yielding one chunk per batch."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(serializer.fields)
+    count = 0
+    async for row in rows:
+        writer.writerow(row[: len(serializer.fields)])
+        count += 1
+        if count >= EXPORT_BATCH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    yield buffer.getvalue()
@@ -0,0 +1,20 @@
+import base64
+import json
+
+
+def encode_cursor(last_id: int) -> str:
+    """Build an opaque cursor pointing right after the row with the given id."""
+    data = json.dumps({"id": last_id}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    """Return the id encoded by `encode_cursor`, raise ValueError if it's malformed."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        last_id = data["id"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor}.")
+    if not isinstance(last_id, int) or isinstance(last_id, bool):
+        raise ValueError(f"Invalid cursor: {cursor}.")
+    return last_id